@@ -1,71 +1,526 @@
 import asyncio
 import os
+import signal
+import socket
+import sys
 import time
 
+from srd.libs._codec import pack, unpack, unpack_value
+from srd.libs._rpc import (ERROR, PASS_FDS, READY, REPLY, RemoteError, _acomm,
+                            aclose, listen, read_frame, server_stats,
+                            start_servers, unlink, write_frame)
+
 WORKINGDIR = os.path.dirname(os.path.realpath(__file__))
+WORKER = os.path.join(WORKINGDIR, 'libs', '_worker.py')
+# interpreters kept started, with the hardware libraries imported
+POOL_SIZE = int(os.environ.get('SRD_POOL_SIZE', 2))
+# servers started by ENSURE are pinged every HEALTH_INTERVAL seconds and
+# killed after HEALTH_MISSES pings in a row got no answer
+HEALTH_INTERVAL = 5
+HEALTH_TIMEOUT = 2
+HEALTH_MISSES = 3
+# restarts back off from RESTART_DELAY, doubling up to MAX_RESTART_DELAY, and
+# start over from RESTART_DELAY once a server ran for STABLE_TIME
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30
+STABLE_TIME = 60
+# servers started by START are stopped after IDLE_TIMEOUT seconds without a
+# request, and the least recently used of them when there are more than
+# MAX_SERVERS or all servers together use more than MAX_RSS megabytes, 0 for
+# no limit. Their requests are counted every IDLE_INTERVAL seconds. They hold
+# state their proxies can not restore, an opened device or a configured
+# FPGA, so they are only stopped, for being idle or to make room, when asked
+# to.
+IDLE_TIMEOUT = float(os.environ.get('SRD_IDLE_TIMEOUT', 0))
+MAX_SERVERS = int(os.environ.get('SRD_MAX_SERVERS', 0))
+MAX_RSS = float(os.environ.get('SRD_MAX_RSS', 0))
+IDLE_INTERVAL = 10
+# cluster mode: this supervisor is NODE, the supervisors listed in SRD_PEERS
+# as host[:port] are asked to join, and the modules in SRD_OWNS, such as
+# 'devs blue_mot_2d.py,libs _ok.py', run here whichever node is asked for
+# them. An instance of a module, named by the module and its resource as in
+# 'libs _serial.py /dev/ttyUSB0', is routed on its own, and falls back on the
+# route of the module. Nodes exchange their routes every CLUSTER_INTERVAL
+# seconds.
+PORT = int(os.environ.get('SRD_PORT', 42922))
+NODE = os.environ.get('SRD_NODE', socket.gethostname()), PORT
+PEERS = [(host, int(port or PORT)) for host, _, port in
+         (peer.partition(':') for peer in
+          os.environ.get('SRD_PEERS', '').split(',') if peer)]
+OWNS = {module for module in os.environ.get('SRD_OWNS', '').split(',')
+        if module}
+CLUSTER_INTERVAL = 30
 
-events = {}
 ports = {}
 processes = {}
-pid = 0 
+# [requests handled, time of the last one] of the servers started by START
+usage = {}
+# listening sockets the supervisor keeps for the servers started by ENSURE
+sockets = {}
+pool = []
+starting = {}
+tasks = set()
+# the node each module or instance is routed to, the other nodes, and the node
+# of each (host, port) of a server started on another node
+routes = {module: NODE for module in OWNS}
+nodes = set(PEERS)
+remote = {}
+
+def handoff(socks, port=0):
+    """ Command line argument telling a server its sockets, and the options
+    to start it with, see _rpc.inherit().
+    """
+    if PASS_FDS:
+        fds = [s.fileno() for s in socks]
+        return ','.join(map(str, fds)), {'pass_fds': fds}
+    return f'port={port}', {'stdout': asyncio.subprocess.PIPE}
+
+async def reported_port(process):
+    """ Port a server that bound its own sockets reports on stdout, None if
+    it exits first. Its other output is passed on.
+    """
+    while True:
+        line = (await process.stdout.readline()).decode(errors='replace')
+        if not line:
+            return None
+        if line.startswith(READY):
+            background(relay(process.stdout))
+            return int(line.split()[-1])
+        print(line, end='')
+
+async def relay(stream):
+    while line := await stream.readline():
+        print(line.decode(errors='replace'), end='')
+
+async def port_of_server(process, socks, port=0):
+    if socks:
+        return port_of(socks)
+    reported = await reported_port(process)
+    if reported is not None:
+        return reported
+    if port:
+        # exited on restart, which supervise() takes care of
+        return port
+    raise RuntimeError(f'server exited with {await process.wait()} before '
+                       f'it reported its port')
+
+async def worker():
+    """ Start a worker, on sockets bound for the server it will run where
+    they can be inherited.
+    """
+    socks = listen(0) if PASS_FDS else ()
+    _, options = handoff(socks)
+    process = await asyncio.create_subprocess_exec(
+            sys.executable, WORKER, stdin=asyncio.subprocess.PIPE, **options)
+    return process, socks
+
+def warm():
+    """ Start a worker in the background and add it to the pool. """
+    pool.append(asyncio.ensure_future(worker()))
+
+async def spawn(paths, socks=None, port=0):
+    """ Run the module at paths as a server.
+
+    The supervisor binds the listening sockets of the server, so its port is
+    known right away, and the server inherits them. Unless the sockets are
+    given, the module is handed to a warm worker if there is one, which is
+    replaced right away, and else started in a new interpreter.
+
+    Where sockets can not be inherited, on windows, the server binds port
+    itself, any if 0, and the supervisor waits until the server reports it;
+    the sockets are empty then.
+
+    Returns:
+        the process, the port and the listening sockets of the server
+    Raises:
+        FileNotFoundError: there is no module at paths
+    """
+    path = os.path.join(WORKINGDIR, *paths)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'no module {" ".join(paths)}')
+    while socks is None and pool:
+        process, socks_ = await pool.pop(0)
+        warm()
+        arg, _ = handoff(socks_)
+        try:
+            process.stdin.write(f'{path} {arg}\n'.encode())
+            await process.stdin.drain()
+            process.stdin.close()
+        except ConnectionError:
+            # the worker died while waiting
+            await process.wait()
+            close(socks_)
+            if socks_:
+                unlink(port_of(socks_))
+            continue
+        return process, await port_of_server(process, socks_), socks_
+    if socks is None:
+        socks = listen(0) if PASS_FDS else ()
+    arg, options = handoff(socks, port)
+    process = await asyncio.create_subprocess_exec(
+            sys.executable, path, arg, **options)
+    return process, await port_of_server(process, socks, port), socks
+
+def close(socks):
+    for s in socks:
+        s.close()
+
+async def terminate_process(process):
+    """ Terminate a server and wait for it, also if it already exited. """
+    try:
+        process.terminate()
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+def port_of(socks):
+    return socks[0].getsockname()[1]
+
+def background(coro):
+    task = asyncio.ensure_future(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+async def reap(port, process):
+    """ Drop a started server from the registry once it exits. """
+    await process.wait()
+    if processes.get(port) is process:
+        del processes[port]
+        usage.pop(port, None)
+        unlink(port)
+        await aclose(('localhost', port))
+
+async def requests_handled(port):
+    """ Requests handled by the server on port, other than STATS. """
+    r = await _acomm('STATS', b'', ('localhost', port), timeout=HEALTH_TIMEOUT)
+    return sum(stages['call']['count']
+               for action, stages in unpack_value(r).items()
+               if action != 'STATS' and 'call' in stages)
+
+def rss(process):
+    """ Resident memory of process in bytes, 0 where /proc is missing. """
+    try:
+        with open(f'/proc/{process.pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+async def poll_usage():
+    """ Update when each started server last handled a request. """
+    for port, use in list(usage.items()):
+        try:
+            count = await requests_handled(port)
+        except (OSError, RemoteError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError):
+            continue
+        if count != use[0]:
+            use[:] = count, time.monotonic()
+
+def least_recently_used():
+    return sorted(usage, key=lambda port: usage[port][1])
+
+async def evict(port, reason):
+    print(f'stopping server on {port}, {reason}')
+    await stop(port)
+
+async def make_room():
+    """ Stop least recently used servers to stay within MAX_SERVERS. """
+    if MAX_SERVERS and len(usage) >= MAX_SERVERS:
+        await poll_usage()
+        for port in least_recently_used()[:len(usage) - MAX_SERVERS + 1]:
+            await evict(port, f'more than {MAX_SERVERS} servers')
+
+async def sweep():
+    """ Stop the started servers that are idle or over MAX_RSS.
 
-def consume(data):
-    parts = data.partition(b' ')
-    return parts[0].decode(), parts[2]
+    Servers may exit or be stopped while this waits for another to stop, so
+    the ones gone are skipped.
+    """
+    await poll_usage()
+    now = time.monotonic()
+    if IDLE_TIMEOUT:
+        for port in least_recently_used():
+            use = usage.get(port)
+            if use is not None and now - use[1] > IDLE_TIMEOUT:
+                await evict(port, f'idle for {now - use[1]:.0f} s')
+    if MAX_RSS:
+        total = sum(map(rss, list(processes.values())))
+        for port in least_recently_used():
+            if total <= MAX_RSS * 1e6:
+                break
+            process = processes.get(port)
+            if process is None:
+                continue
+            used = rss(process)
+            await evict(port, f'servers use {total / 1e6:.0f} MB')
+            total -= used
+
+async def reap_idle():
+    """ Sweep every IDLE_INTERVAL seconds, forever. """
+    while True:
+        await asyncio.sleep(IDLE_INTERVAL)
+        try:
+            await sweep()
+        except Exception as e:
+            print(f'reaping idle servers failed, {type(e).__name__}: {e}')
+
+async def watch(port, process):
+    """ Wait for the server to exit, killing it if it stops answering. """
+    exited = asyncio.ensure_future(process.wait())
+    misses = 0
+    while not exited.done():
+        await asyncio.wait([exited], timeout=HEALTH_INTERVAL)
+        if exited.done():
+            break
+        try:
+            await _acomm('_echo', pack(b''), ('localhost', port),
+                         timeout=HEALTH_TIMEOUT)
+            misses = 0
+        except RemoteError:
+            # answered, only not to _echo
+            misses = 0
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            misses += 1
+            if misses == HEALTH_MISSES:
+                print(f'server on {port} is not answering, killing it')
+                process.kill()
+    await exited
+
+async def supervise(module, port, socks):
+    """ Restart the server of module until it is stopped.
+
+    The supervisor keeps the listening sockets of the server, so a restarted
+    server keeps its port and clients connecting in between wait in the
+    backlog. Restarts of a server that keeps failing are spaced out.
+    """
+    delay = RESTART_DELAY
+    while True:
+        process = processes[port]
+        t0 = time.monotonic()
+        await watch(port, process)
+        if processes.get(port) is not process:
+            # stopped
+            break
+        if time.monotonic() - t0 > STABLE_TIME:
+            delay = RESTART_DELAY
+        print(f'{module} exited with {process.returncode}, '
+              f'restarting in {delay} s')
+        server_stats.error('RESTART')
+        await asyncio.sleep(delay)
+        delay = min(2 * delay, MAX_RESTART_DELAY)
+        if processes.get(port) is not process:
+            break
+        restarted, _, _ = await spawn(module.split(" "), socks, port)
+        if processes.get(port) is not process:
+            # stopped while it was starting
+            await terminate_process(restarted)
+            break
+        processes[port] = restarted
+    close(socks)
+    unlink(port)
+
+async def start(module):
+    try:
+        process, port, socks = await spawn(module.split(" "))
+        processes[port] = process
+        ports[module] = port
+        sockets[port] = socks
+        background(supervise(module, port, socks))
+        return port
+    finally:
+        del starting[module]
+
+async def ensure(module):
+    """ Port of the server of module, which is started if not running.
+
+    Concurrent calls for a module that is being started wait for the same
+    start, so there is never more than one server per module. The server is
+    restarted whenever it exits or stops answering, see supervise().
+    """
+    if module in ports:
+        return ports[module]
+    if module not in starting:
+        starting[module] = asyncio.ensure_future(start(module))
+    # a client going away must not cancel the start the others wait for
+    return await asyncio.shield(starting[module])
+
+async def stop(port):
+    process = processes.pop(port, None)
+    if process is None:
+        # already evicted
+        return
+    usage.pop(port, None)
+    for module, port_ in list(ports.items()):
+        if port_ == port:
+            del ports[module]
+    # refuse new connections right away, so clients notice the server is gone
+    close(sockets.pop(port, ()))
+    await terminate_process(process)
+    unlink(port)
+    await aclose(('localhost', port))
 
 async def handle_request(reader, writer):
-    global pid
-    read = await reader.read(1024)
-    method, arg = consume(read)
-    print(method, arg)
+    # each request is handled on a task of its own, so a slow START does not
+    # hold up the requests pipelined behind it
+    pending = set()
+    while True:
+        try:
+            _, rid, method, arg = await read_frame(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            break
+        task = asyncio.ensure_future(dispatch(rid, method, arg, writer))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    await asyncio.gather(*pending, return_exceptions=True)
+    writer.close()
 
-    if method.upper() == 'START':
-        pid += 1
-        paths = arg.decode().split(" ")
-        events[pid] = asyncio.Event()
-        cmd = f'python {os.path.join(WORKINGDIR, *paths)} {pid}'
-        process = await asyncio.create_subprocess_shell(cmd)
-        await events[pid].wait()
-        processes[ports[pid]] = process
-        writer.write(f"{ports[pid]}".encode())
-        await writer.drain()
-    elif method.upper() == 'ENSURE':
-        paths = arg.decode().split(" ")
-        pid = paths[-1].strip('.py')
-        if pid not in ports:
-            events[pid] = asyncio.Event()
-            cmd = f'python {os.path.join(WORKINGDIR, *paths)} {pid}'
-            process = await asyncio.create_subprocess_shell(cmd)
-            await events[pid].wait()
-            processes[ports[pid]] = process
-        writer.write(f"{ports[pid]}".encode())
-        await writer.drain()
-    elif method.upper() == 'STOP':
-        pid_ = int(arg)
-        processes[pid_].terminate()
-        await processes[pid_].wait()
-        writer.write(b' ')
-        await writer.drain()
-    elif method.upper() == 'PORT':
-        split = arg.split(b" ")
-        pid_ = split[0].decode()
-        port_ = int(split[1])
-        ports[pid_] = port_
-        writer.write(b' ')
+def merge(node, owned, known_routes, known_nodes):
+    """ Take in the routes of another node. """
+    node = tuple(node)
+    nodes.add(node)
+    for module in owned:
+        if module not in OWNS:
+            routes[module] = node
+    for module, owner in known_routes.items():
+        routes.setdefault(module, tuple(owner))
+    nodes.update(tuple(n) for n in known_nodes)
+    nodes.discard(NODE)
+
+def module_of(name):
+    """ Module of a module or instance name, 'libs _serial.py' of
+    'libs _serial.py /dev/ttyUSB0'.
+    """
+    return ' '.join(name.split(' ', 2)[:2])
+
+def route(name):
+    """ Node a module or instance is routed to. """
+    return routes.get(name) or routes.get(module_of(name), NODE)
+
+def cluster_state():
+    return pack(NODE, sorted(OWNS), routes, sorted(nodes))
+
+async def gossip():
+    """ Exchange routes with every other node, forever. """
+    while True:
+        for node in list(nodes):
+            try:
+                r = await _acomm('JOIN', cluster_state(), node, timeout=5)
+            except (OSError, RemoteError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError):
+                continue
+            merge(*unpack(r))
+        await asyncio.sleep(CLUSTER_INTERVAL)
+
+async def forward(action, name, node):
+    """ Have node START or ENSURE a module or instance, return the host and
+    port.
+    """
+    r = await _acomm(f'{action}_LOCAL', name.encode(), node)
+    host, port = node[0], int(r.decode().rpartition(' ')[2])
+    remote[host, port] = node
+    return host, port
+
+async def dispatch(rid, method, arg, writer):
+    """ Handle a request and reply to it, with an ERROR frame if it failed,
+    which the client raises as RemoteError.
+    """
+    print(method, arg)
+    t0 = time.perf_counter()
+    try:
+        kind, reply = REPLY, await respond(method, arg)
+    except Exception as e:
+        kind, reply = ERROR, f'{type(e).__name__}: {e}'.encode()
+    server_stats.record(method.upper(), 'call', time.perf_counter() - t0)
+    write_frame(writer, kind, rid, method, reply)
+    try:
         await writer.drain()
-        events[pid_].set()
+    except ConnectionError:
+        pass
+
+async def respond(method, arg):
+    """ Carry out a request and return the payload of the reply. """
+    action = method.upper()
+    # START and ENSURE are routed to the node that owns the module, the
+    # _LOCAL variants sent by other nodes are not
+    local = action.endswith('_LOCAL')
+    if local:
+        action = action[:-len('_LOCAL')]
+
+    if action in ('START', 'ENSURE') and not local and \
+            route(arg.decode()) != NODE:
+        host, port = await forward(action, arg.decode(), route(arg.decode()))
+        return f"{host} {port}".encode()
+    elif action == 'START':
+        await make_room()
+        paths = module_of(arg.decode()).split(" ")
+        process, port, socks = await spawn(paths)
+        # the server has its own copies now
+        close(socks)
+        processes[port] = process
+        usage[port] = [0, time.monotonic()]
+        background(reap(port, process))
+        return f"{port}".encode()
+    elif action == 'ENSURE':
+        # one server runs all instances of a module here
+        port = await ensure(module_of(arg.decode()))
+        return f"{port}".encode()
+    elif action == 'STOP':
+        # the host is given for servers that may run on another node
+        host, _, port = arg.decode().rpartition(' ')
+        node = remote.pop((host, int(port)), None)
+        if node is None:
+            await stop(int(port))
+        else:
+            await _acomm('STOP', port.encode(), node)
+        return b' '
+    elif action == 'JOIN':
+        merge(*unpack(arg))
+        return cluster_state()
+    elif action == 'ROUTES':
+        return pack(routes)
+    elif action == 'STATS':
+        return pack(server_stats.snapshot())
     else:
         print('Invalid command')
-        writer.write(b' ')
-        await writer.drain()
+        raise ValueError(f'invalid command {method}')
+
+def cleanup():
+    """ Remove the unix sockets of the supervisor, its servers and its warm
+    workers.
+    """
+    unlink(PORT)
+    for port in processes:
+        unlink(port)
+    for worker_ in pool:
+        if worker_.done() and not worker_.cancelled() and \
+                worker_.exception() is None and worker_.result()[1]:
+            unlink(port_of(worker_.result()[1]))
 
+def terminate():
+    """ Exit right away on SIGTERM, as without a handler, but clean up. """
+    cleanup()
+    sys.stdout.flush()
+    os._exit(0)
 
 async def main():
-    server = await asyncio.start_server(handle_request, '0.0.0.0', 42922)
+    for _ in range(POOL_SIZE):
+        warm()
+    background(reap_idle())
+    background(gossip())
+    server, *local = await start_servers(handle_request, PORT)
     addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
     print(f'serving on {addrs}')
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,
+                                                      terminate)
+    except NotImplementedError:
+        # no signal handlers on windows, where it is simply killed
+        pass
     async with server:
         await server.serve_forever()
 
 if __name__ == "__main__":
-    asyncio.run(main(), debug=False)
+    try:
+        asyncio.run(main(), debug=False)
+    finally:
+        cleanup()
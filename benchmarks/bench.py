@@ -0,0 +1,248 @@
+""" Throughput and latency of the proxies against stand-in hardware.
+
+    python benchmarks/bench.py [-n 2000]
+
+Starts the supervisor from __init__.py with benchmarks/fakes first on the
+path, so the servers it spawns drive the fake pyvisa and ok modules instead
+of hardware. A pty whose far end echoes everything back stands in for the
+serial port. For each operation the ops/s and the p50 and p99 latency are
+printed, and the transfer rate for bulk transfers.
+
+The supervisor listens on its fixed port 42922, so none may be running yet.
+"""
+import argparse
+import atexit
+import os
+import pty
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+INITHOST = ('localhost', 42922)
+
+def _package_dir():
+    """ Directory from which the repository imports as srd. """
+    if os.path.basename(ROOT) == 'srd':
+        return os.path.dirname(ROOT)
+    path = tempfile.mkdtemp(prefix='srd-bench-')
+    link = os.path.join(path, 'srd')
+    os.symlink(ROOT, link)
+    # the link, not what it points to
+    atexit.register(os.rmdir, path)
+    atexit.register(os.unlink, link)
+    return path
+
+def report(name, durations, nbytes=0):
+    durations = sorted(durations)
+    n = len(durations)
+    ops = n / sum(durations)
+    p50 = durations[n // 2]
+    p99 = durations[min(n - 1, int(n * 0.99))]
+    line = (f'{name:<32} {n:>6} {ops:>10.1f} ops/s '
+            f'p50 {p50 * 1e3:>9.3f} ms  p99 {p99 * 1e3:>9.3f} ms')
+    if nbytes:
+        line += f'  {nbytes * ops / 1e6:>8.1f} MB/s'
+    print(line, flush=True)
+
+def measure(name, op, n, nbytes=0):
+    op()
+    durations = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        op()
+        durations.append(time.perf_counter() - t0)
+    report(name, durations, nbytes)
+
+def environment(**variables):
+    """ Make srd and the fakes importable here and in the servers.
+
+    Returns:
+        (dict) environment of the supervisor, with variables added
+    """
+    path = [_package_dir(), os.path.join(HERE, 'fakes')]
+    sys.path[:0] = path
+    env = dict(os.environ, **variables)
+    env['PYTHONPATH'] = os.pathsep.join(
+            path + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+def start_supervisor(env):
+    process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, '__init__.py')], env=env,
+            stdout=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(INITHOST, timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('supervisor did not start')
+            time.sleep(0.05)
+
+def loopback():
+    """ Open a pty echoing back all it is sent, return the port name. """
+    master, slave = pty.openpty()
+
+    def echo():
+        while True:
+            try:
+                data = os.read(master, 65536)
+            except OSError:
+                return
+            os.write(master, data)
+
+    threading.Thread(target=echo, daemon=True).start()
+    # the slave stays open so the master does not see a hangup between opens
+    loopback.fds = master, slave
+    return os.ttyname(slave)
+
+def bench_spawn(n):
+    from srd.libs._pyvisa import PyvisaProxy
+    from srd.libs._ok import OKProxy
+
+    # the supervisor replies with the port before the server is up, so the
+    # first call is part of the spawn time
+    first_calls = {PyvisaProxy: lambda lib: lib._echo('ping'),
+                   OKProxy: lambda lib: lib.okCFrontPanelDevices().GetCount()}
+    for cls, first_call in first_calls.items():
+        durations = []
+        for _ in range(n):
+            # give the supervisor time to warm up a worker for it
+            time.sleep(1)
+            t0 = time.perf_counter()
+            first_call(cls(INITHOST))
+            durations.append(time.perf_counter() - t0)
+        report(f'START {cls.__name__}', durations)
+
+def bench_device(n):
+    from srd.devs import test_psu
+    from srd.libs import _rpc
+
+    time.sleep(1)
+    t0 = time.perf_counter()
+    psu = test_psu.DeviceProxy(INITHOST)
+    psu._echo('ping')
+    report('ENSURE test_psu, cold', [time.perf_counter() - t0])
+    measure('ENSURE test_psu, running',
+            lambda: _rpc._comm('ENSURE', b'devs test_psu.py', INITHOST), n)
+    measure('DeviceProxy() of test_psu',
+            lambda: test_psu.DeviceProxy(INITHOST), n)
+
+    measure('device _echo', lambda: psu._echo('ping'), n)
+    measure('device getter', lambda: psu.measured_voltage, n)
+
+    def set_voltage():
+        psu.voltage_setpoint = 1.5
+    measure('device setter', set_voltage, n)
+    measure('device get, 5 pipelined',
+            lambda: psu.get('output', 'voltage_setpoint', 'measured_voltage',
+                            'current_setpoint', 'measured_current'), n)
+    return psu
+
+def bench_visa(n):
+    from srd.libs._pyvisa import PyvisaProxy
+
+    visa = PyvisaProxy(INITHOST)
+    rm = visa.ResourceManager()
+    inst = rm.open_resource('GPIB0::5::INSTR')
+    measure('visa query', lambda: inst.query('MEAS:VOLT?'), n)
+    measure('visa write', lambda: inst.write('VOLT 1.5'), n)
+    return visa
+
+def bench_serial(n):
+    try:
+        import serial
+    except ImportError:
+        print('serial: skipped, pyserial is not installed')
+        return
+    from srd.libs._serial import SerialProxy
+
+    lib = SerialProxy(INITHOST)
+    port = loopback()
+    for label, buffer_size in ('', None), (', buffered', 1 << 16):
+        ser = lib.Serial(port=port, baudrate=115200, timeout=1,
+                         buffer_size=buffer_size)
+        command = b'MEAS:VOLT?\n'
+
+        def query():
+            ser.write(command)
+            ser.read_until(b'\n')
+        measure(f'serial write + read_until{label}', query, n)
+        measure(f'serial query{label}', lambda: ser.query(command), n)
+        measure(f'serial query_batch of 10{label}',
+                lambda: ser.query_batch([command] * 10), max(n // 10, 1))
+
+        block = bytes(range(256)) * 16
+        def bulk():
+            ser.write(block)
+            ser.read(len(block))
+        measure(f'serial 4 KiB write + read{label}', bulk, max(n // 10, 1),
+                len(block))
+        ser.close()
+
+    ser = lib.Serial(port=port, baudrate=115200, timeout=1)
+    measure('serial baudrate, cached', lambda: ser.baudrate, n)
+    lines = ser.subscribe()
+    batch = b'$WAVE,1234.56789,OK\n' * 100
+    def receive():
+        ser.write(batch)
+        for _ in range(100):
+            next(lines)
+    measure('serial subscribe, 100 lines', receive, max(n // 10, 1),
+            len(batch))
+    lines.close()
+    ser.close()
+    return lib
+
+def bench_ok(n):
+    from srd.libs._ok import OKProxy, PipeBuffer, okCFrontPanelProxy
+
+    lib = OKProxy(INITHOST)
+    xem = lib.okCFrontPanelDevices().Open()
+    measure('ok SetWireInValue', lambda: xem.SetWireInValue(0x00, 0x1234), n)
+    ops = [('SetWireInValue', (i, i)) for i in range(15)]
+    ops.append(('UpdateWireIns', ()))
+    measure('ok Batch of 16', lambda: xem.Batch(ops), n)
+
+    # linux answers all of 127/8 on loopback, but only 127.0.0.1 counts as
+    # local, so this takes the tcp path of a remote client
+    remote = okCFrontPanelProxy(('127.0.0.2', xem._host[1]))
+    for size in 1 << 20, 16 << 20:
+        label = f'{size >> 20} MiB'
+        data = bytes(size)
+        buf = PipeBuffer(size)
+        count = max(n // (10 if size == 1 << 20 else 100), 1)
+        measure(f'ok pipe {label}, tcp',
+                lambda: remote.WriteToPipeIn(0x80, data), count, size)
+        measure(f'ok pipe {label}, shared',
+                lambda: xem.WriteToPipeIn(0x80, data), count, size)
+        measure(f'ok pipe {label}, PipeBuffer',
+                lambda: xem.WriteToPipeIn(0x80, buf), count, size)
+        buf.close()
+    return lib
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=2000,
+                        help='repetitions of the fast operations')
+    args = parser.parse_args()
+
+    supervisor = start_supervisor(environment())
+    try:
+        bench_spawn(max(args.n // 500, 3))
+        for bench in bench_device, bench_visa, bench_serial, bench_ok:
+            # the visa and ok proxies stop their servers when they go out of
+            # scope here, the device and serial servers are shared and keep
+            # running until the supervisor is stopped
+            bench(args.n)
+    finally:
+        os.killpg(supervisor.pid, 15)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+""" Concurrent ENSUREs of one device must start exactly one server.
+
+    python benchmarks/ensure.py [-n 32]
+
+Fires n ENSUREs of devs/test_psu.py at once at a fresh supervisor, reports
+their latency and checks that all got the same port and that the supervisor
+has a single test_psu child. Linux only, children are found through /proc.
+"""
+import argparse
+import os
+import threading
+import time
+
+from bench import INITHOST, environment, report, start_supervisor
+
+def children(pid, name):
+    """ Pids of the children of pid whose command line mentions name. """
+    found = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rpartition(')')[2].split()[1])
+            with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                cmdline = f.read()
+        except OSError:
+            continue
+        if ppid == pid and name.encode() in cmdline:
+            found.append(int(entry))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=32,
+                        help='number of concurrent ENSUREs')
+    args = parser.parse_args()
+
+    # without warm workers the children show the module they run
+    supervisor = start_supervisor(environment(SRD_POOL_SIZE='0'))
+    try:
+        from srd.libs import _rpc
+
+        barrier = threading.Barrier(args.n)
+        ports = [None] * args.n
+        durations = [None] * args.n
+
+        def ensure(i):
+            barrier.wait()
+            t0 = time.perf_counter()
+            r = _rpc._comm('ENSURE', b'devs test_psu.py', INITHOST, timeout=10)
+            durations[i] = time.perf_counter() - t0
+            ports[i] = int(r.decode())
+
+        threads = [threading.Thread(target=ensure, args=(i,))
+                   for i in range(args.n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report(f'ENSURE x{args.n} concurrent', durations)
+
+        servers = children(supervisor.pid, 'test_psu.py')
+        print(f'ports {sorted(set(ports))}, test_psu servers {servers}')
+        assert len(set(ports)) == 1, 'ENSUREs got different ports'
+        assert len(servers) == 1, f'{len(servers)} test_psu servers started'
+    finally:
+        os.killpg(supervisor.pid, 15)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+""" Stand-in for the Opal Kelly FrontPanel module with one XEM in memory.
+
+WireIns are latched by UpdateWireIns, WireOuts echo the latched WireIn with
+the same offset (0x20 + n reads back 0x00 + n), every trigger reads as fired
+and pipe writes are counted. FAKE_OK_RATE limits pipe writes to that many
+bytes per second to mimic USB, and FAKE_OK_OPEN sets the time to enumerate
+the devices, in seconds.
+"""
+import os
+import time
+
+_RATE = float(os.environ.get('FAKE_OK_RATE', 0))
+_OPEN = float(os.environ.get('FAKE_OK_OPEN', 0))
+
+class okCFrontPanel(object):
+    NoError = 0
+
+    def __init__(self, serial='FAKE0001'):
+        self._serial = serial
+        self._wire_ins = {}
+        self._latched = {}
+        self.pipe_bytes = {}
+
+    def Close(self):
+        pass
+
+    def ConfigureFPGA(self, strFilename):
+        return self.NoError
+
+    def GetSerialNumber(self):
+        return self._serial
+
+    def GetWireInValue(self, epAddr):
+        return self._wire_ins.get(epAddr, 0)
+
+    def GetWireOutValue(self, epAddr):
+        return self._latched.get(epAddr - 0x20, 0)
+
+    def IsTriggered(self, epAddr, mask):
+        return True
+
+    def SetWireInValue(self, epAddr, val, mask=0xffffffff):
+        old = self._wire_ins.get(epAddr, 0)
+        self._wire_ins[epAddr] = (old & ~mask | val & mask) & 0xffffffff
+        return self.NoError
+
+    def UpdateTriggerOuts(self):
+        return self.NoError
+
+    def UpdateWireIns(self):
+        self._latched = dict(self._wire_ins)
+        return self.NoError
+
+    def UpdateWireOuts(self):
+        return self.NoError
+
+    def WriteToPipeIn(self, epAddr, data):
+        n = len(data)
+        if _RATE:
+            time.sleep(n / _RATE)
+        self.pipe_bytes[epAddr] = self.pipe_bytes.get(epAddr, 0) + n
+        return n
+
+class okCFrontPanelDevices(object):
+    def __init__(self, realm=''):
+        time.sleep(_OPEN)
+        self._serials = ['FAKE0001']
+
+    def GetCount(self):
+        return len(self._serials)
+
+    def GetSerial(self, num=0):
+        return self._serials[num] if 0 <= num < len(self._serials) else ''
+
+    def Open(self, serial=''):
+        if serial and serial not in self._serials:
+            return None
+        return okCFrontPanel(serial or self._serials[0])
@@ -0,0 +1,93 @@
+""" Stand-in for pyvisa answering a small SCPI subset from memory.
+
+Every resource keeps a table of settings. `HEAD value` stores a setting,
+`HEAD?` returns it. Commands may be chained with ';', and a `:SLOT n` selects
+the table of slot n. Long form headers starting with ':' are echoed in the
+answer, as the laser diode mainframes do (`:ILD:SET?` -> `:ILD:SET 0.1`).
+
+FAKE_VISA_DELAY sets the time each query and write takes, in seconds, to
+mimic the bus, and FAKE_VISA_OPEN the time to create the resource manager.
+"""
+import os
+import time
+
+_DELAY = float(os.environ.get('FAKE_VISA_DELAY', 0))
+_OPEN = float(os.environ.get('FAKE_VISA_OPEN', 0))
+
+_DEFAULTS = {'*IDN': 'srd,fake instrument,0,0',
+             'OUTP': '0',
+             'VOLT': '1.5',
+             'CURR': '0.25',
+             'MEAS:VOLT': '1.5',
+             'MEAS:CURR': '0.25',
+             ':LASER': 'OFF',
+             ':ILD:SET': '0.1',
+             ':POPT:ACT': '0.001'}
+
+class Resource(object):
+    timeout = 2000
+    query_delay = 0
+
+    def __init__(self, resource_name):
+        self.resource_name = resource_name
+        self._slots = {}
+        self._slot = 0
+        self._answer = ''
+
+    def _settings(self):
+        return self._slots.setdefault(self._slot, dict(_DEFAULTS))
+
+    def _execute(self, command):
+        head, _, value = command.strip().partition(' ')
+        settings = self._settings()
+        if head == ':SLOT':
+            self._slot = int(value)
+        elif head.endswith('?'):
+            head = head[:-1]
+            answer = settings[head]
+            if head.startswith(':'):
+                answer = f'{head} {answer}'
+            self._answer = answer
+        elif head.startswith('MEAS:'):
+            raise ValueError(f'{head} is a query')
+        else:
+            if not head.startswith(':'):
+                value = {'ON': '1', 'OFF': '0'}.get(value, value)
+            settings[head] = value
+            if head in ('VOLT', 'CURR'):
+                settings[f'MEAS:{head}'] = value
+
+    def write(self, message, termination=None, encoding=None):
+        if _DELAY:
+            time.sleep(_DELAY)
+        for command in message.split(';'):
+            self._execute(command)
+        return len(message) + 1
+
+    def read(self, termination=None, encoding=None):
+        answer, self._answer = self._answer, ''
+        return answer + '\n'
+
+    def query(self, message, delay=None):
+        self.write(message)
+        return self.read()
+
+    def control_ren(self, mode):
+        return 0
+
+    def close(self):
+        pass
+
+class ResourceManager(object):
+    def __init__(self, visa_library=''):
+        time.sleep(_OPEN)
+        self._resources = [f'GPIB0::{i}::INSTR' for i in range(1, 31)]
+
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self._resources)
+
+    def open_resource(self, resource_name, open_timeout=0, **kwargs):
+        resource = Resource(resource_name)
+        for name, value in kwargs.items():
+            setattr(resource, name, value)
+        return resource
@@ -0,0 +1,71 @@
+""" Startup profile of the lib and device servers.
+
+    python benchmarks/startup.py [--cold]
+
+Starts each server through the supervisor, with START or ENSURE as its
+proxies do, and prints the time until the supervisor replied with its port,
+the time until the server reported ready, and the split the server itself
+reports through _ready: the time it took to import, up to opening its
+hardware, and the time opening took. --cold starts every server in a new
+interpreter instead of a warm worker.
+
+Opening the fake backends takes FAKE_VISA_OPEN and FAKE_OK_OPEN seconds, 0.5
+unless set.
+"""
+import argparse
+import os
+import time
+
+from bench import INITHOST, environment, start_supervisor
+
+# the action each server is started with by its proxies
+MODULES = [('ENSURE', 'libs _serial.py'),
+           ('START', 'libs _pyvisa.py'),
+           ('START', 'libs _ok.py'),
+           ('ENSURE', 'devs test_psu.py')]
+
+def profile(action, module):
+    from srd.libs import _rpc
+    from srd.libs._codec import unpack_value
+
+    t0 = time.perf_counter()
+    host = _rpc.endpoint(_rpc._comm(action, module.encode(), INITHOST),
+                         INITHOST)
+    t_port = time.perf_counter() - t0
+    while True:
+        state = unpack_value(_rpc._comm('_ready', b'', host))
+        if state['state'] != 'opening':
+            break
+        time.sleep(0.001)
+    t_ready = time.perf_counter() - t0
+    _rpc._comm('STOP', f'{host[0]} {host[1]}'.encode(), INITHOST)
+
+    def ms(seconds):
+        return '-' if seconds is None else f'{seconds * 1e3:.1f}'
+    print(f'{module:<20} {ms(t_port):>8} {ms(t_ready):>8} '
+          f'{ms(state["import"]):>8} {ms(state["open"]):>8}  '
+          f'{state["state"]} {state["error"] or ""}', flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cold', action='store_true',
+                        help='start the servers without warm workers')
+    args = parser.parse_args()
+
+    variables = {'FAKE_VISA_OPEN': os.environ.get('FAKE_VISA_OPEN', '0.5'),
+                 'FAKE_OK_OPEN': os.environ.get('FAKE_OK_OPEN', '0.5')}
+    if args.cold:
+        variables['SRD_POOL_SIZE'] = '0'
+    supervisor = start_supervisor(environment(**variables))
+    try:
+        print(f'{"module":<20} {"port":>8} {"ready":>8} {"import":>8} '
+              f'{"open":>8}  ms')
+        for action, module in MODULES:
+            # give the supervisor time to warm up a worker for it
+            time.sleep(1)
+            profile(action, module)
+    finally:
+        os.killpg(supervisor.pid, 15)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+""" Driver shared by the blue MOT laser diode slots. """
+
+class Device(object):
+    """ One laser diode slot of the mainframe at _gpib_address, reached
+    through the pyvisa lib server at _host, or the local pyvisa if _host is
+    None.
+    """
+    _gpib_address = None
+    _host = None
+    _slot = None
+
+    def __init__(self):
+        if self._host is not None:
+            from srd.libs._pyvisa import PyvisaProxy
+            pyvisa = PyvisaProxy(self._host)
+        else:
+            import pyvisa
+
+        rm = pyvisa.ResourceManager()
+        self._inst = rm.open_resource(self._gpib_address)
+    
+    @property
+    def output(self) -> bool:
+        r = self._inst.query(f':SLOT {self._slot};:LASER?').strip()
+        if r == ':LASER ON':
+            return True
+        elif r == ':LASER OFF':
+            return False
+
+    @output.setter
+    def output(self, output: bool):
+        if output:
+            self._inst.write(f':SLOT {self._slot};:LASER ON')
+        else: 
+            self._inst.write(f':SLOT {self._slot};:LASER OFF')
+
+    @property
+    def current_setpoint(self) -> float:
+        return float(self._inst.query(f':SLOT {self._slot};:ILD:SET?')[9:])
+
+    @current_setpoint.setter
+    def current_setpoint(self, current_setpoint: float):
+        self._inst.write(f':SLOT {self._slot};:ILD:SET {current_setpoint}')
+
+    @property
+    def optical_power(self) -> float:
+        return float(self._inst.query(f':SLOT {self._slot};:POPT:ACT?')[10:])
@@ -0,0 +1,181 @@
+""" Proxy and server plumbing shared by the device modules.
+
+A device module defines a Device class driving the hardware, whose properties
+are annotated with their type, and builds its proxies and server from it:
+
+    DeviceProxy, AsyncDeviceProxy = _device.proxies(Device, __file__)
+
+    if __name__ == "__main__":
+        _device.serve(Device)
+
+Every annotated property of Device becomes a property of DeviceProxy, read
+with name_getattr and written with name_setattr. The server of a device is
+shared by all its proxies and is left running when a proxy goes away. Its
+port is looked up in _registry, which asks the supervisor only once, and
+resolved again when the server can not be reached, before any request was
+sent. A request that may have reached the server is not sent again.
+Opening the device can take longer than the timeout of a call, so a proxy
+first waits, for as long as ENSURE may take, until its server is done
+opening, once per server and process. New connections to a server that
+restarted wait the same way, see _rpc.expect().
+"""
+import asyncio
+import os
+import sys
+import time
+
+from srd.libs import _registry, _rpc
+from srd.libs._codec import unpack_value
+
+# hosts of the servers this process has seen done opening
+_opened = set()
+
+def _opening(host, state):
+    if state['state'] != 'opening':
+        _opened.add(host)
+        return False
+    return True
+
+class DeviceProxy(_rpc.Proxy):
+    _file = None
+    _inithost = ('localhost', 4292)
+    _timeout = 1.0
+
+    def __init__(self, inithost=None):
+        if inithost is not None:
+            self._inithost = inithost
+        self._host = _registry.resolve(self._module(), self._inithost)
+        if self._host not in _opened:
+            try:
+                self._wait_opened()
+            except ConnectionError:
+                self._reconnect()
+
+    @classmethod
+    def _module(cls):
+        return f'devs {cls._file}'
+
+    def _reconnect(self):
+        # the server went away, and with it maybe the cached port
+        _registry.forget(self._module(), self._inithost)
+        self._host = _registry.resolve(self._module(), self._inithost)
+        self._wait_opened()
+
+    def _wait_opened(self):
+        deadline = time.monotonic() + _rpc.OPEN_TIMEOUT
+        while _opening(self._host, unpack_value(
+                _rpc._comm('_ready', b'', self._host, self._timeout))):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{self._module()} is still opening')
+            time.sleep(0.05)
+
+    def _call(self, action, *args, decode=None):
+        try:
+            return super()._call(action, *args, decode=decode)
+        except _rpc.Unreachable:
+            self._reconnect()
+        return super()._call(action, *args, decode=decode)
+
+    def get(self, *names):
+        try:
+            return super().get(*names)
+        except _rpc.Unreachable:
+            self._reconnect()
+        return super().get(*names)
+
+    def _echo(self, message):
+        return self._call('_echo', message)
+
+class AsyncDeviceProxy(_rpc.AsyncProxy, DeviceProxy):
+    """ asyncio counterpart of DeviceProxy.
+
+    Start it with `dev = await AsyncDeviceProxy.start(inithost)`.
+    """
+    def __init__(self, inithost, host):
+        self._inithost = inithost
+        self._host = host
+
+    @classmethod
+    async def start(cls, inithost=None):
+        inithost = cls._inithost if inithost is None else inithost
+        self = cls(inithost, await _registry.aresolve(cls._module(), inithost))
+        if self._host not in _opened:
+            try:
+                await self._wait_opened()
+            except ConnectionError:
+                await self._reconnect()
+        return self
+
+    async def _reconnect(self):
+        _registry.forget(self._module(), self._inithost)
+        self._host = await _registry.aresolve(self._module(), self._inithost)
+        await self._wait_opened()
+
+    async def _wait_opened(self):
+        deadline = time.monotonic() + _rpc.OPEN_TIMEOUT
+        while _opening(self._host, unpack_value(
+                await _rpc._acomm('_ready', b'', self._host, self._timeout))):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{self._module()} is still opening')
+            await asyncio.sleep(0.05)
+
+    async def _call(self, action, *args, decode=None):
+        try:
+            return await super()._call(action, *args, decode=decode)
+        except _rpc.Unreachable:
+            await self._reconnect()
+        return await super()._call(action, *args, decode=decode)
+
+    async def get(self, *names):
+        try:
+            return await super().get(*names)
+        except _rpc.Unreachable:
+            await self._reconnect()
+        return await super().get(*names)
+
+def proxies(device_cls, file, inithost=('localhost', 4292)):
+    """ Build the proxy classes of a device.
+
+    Args:
+        device_cls: the Device class of the device module
+        file: path of the device module
+        inithost: default (host, port) of the supervisor
+    Returns:
+        DeviceProxy and AsyncDeviceProxy subclasses for device_cls
+    """
+    namespace = _rpc.proxy_attributes(device_cls)
+    namespace.update(_file=os.path.basename(file), _inithost=inithost,
+                     __module__=device_cls.__module__)
+    proxy = type('DeviceProxy', (DeviceProxy,), namespace)
+    async_proxy = type('AsyncDeviceProxy', (AsyncDeviceProxy, proxy),
+                       {'__module__': device_cls.__module__})
+    return proxy, async_proxy
+
+def serve(device_cls, port=65050):
+    """ Serve the device forever.
+
+    The device is opened in the background, so the server answers _echo and
+    _ready right away and requests to the device wait until it is open.
+    When started by the supervisor, the server listens on the sockets the
+    supervisor handed down with the only argument, see _rpc.inherit().
+    Otherwise it listens on port.
+    """
+    dev = None
+
+    def open_device():
+        nonlocal dev
+        dev = device_cls()
+
+    server = _rpc.Dispatcher()
+    server.register('_echo', resource=None)(lambda message: message)
+    server.expose(lambda: dev, resource='dev', cls=device_cls)
+
+    if len(sys.argv) == 2:
+        socks = _rpc.inherit(sys.argv[1])
+    else:
+        socks = _rpc.listen(port)
+        print(f'serving on {socks[0].getsockname()}')
+
+    # the device is opened while the server already answers, see _ready
+    server.open(open_device)
+    _rpc.serve(socks, server, server.resource_of)
@@ -1,7 +1,9 @@
 import asyncio
-import socket
 import sys
 
+from srd.libs._rpc import (ERROR, REPLY, inherit, read_frame, start_servers,
+                            write_frame)
+
 feeds = {}
 messages = {}
 
@@ -10,8 +12,15 @@ def consume(data):
     return parts[0].decode(), parts[2]
 
 async def handle_request(reader, writer):
-    read = await reader.read(1024)
-    method, arg = consume(read)
+    while True:
+        try:
+            _, rid, method, arg = await read_frame(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            break
+        await dispatch(rid, method, arg, writer)
+    writer.close()
+
+async def dispatch(rid, method, arg, writer):
     print(method, arg)
 
     if method.upper() == 'LISTEN':
@@ -19,29 +28,27 @@ async def handle_request(reader, writer):
         if feed not in feeds:
             feeds[feed] = asyncio.Event()
         await feeds[feed].wait()
-        writer.write(messages[feed])
+        write_frame(writer, REPLY, rid, method, messages[feed])
         await writer.drain()
-    if method.upper() == 'ANNOUNCE':
+    elif method.upper() == 'ANNOUNCE':
         feed, message = consume(arg)
         if feed not in feeds:
             feeds[feed] = asyncio.Event()
         messages[feed] = message
-        writer.write(messages[feed])
+        write_frame(writer, REPLY, rid, method, messages[feed])
         await writer.drain()
         feeds[feed].set()
+    else:
+        write_frame(writer, ERROR, rid, method,
+                    f'invalid command {method}'.encode())
+        await writer.drain()
 
 async def main():
-    server = await asyncio.start_server(handle_request, '0.0.0.0', 0)
+    socks = inherit(sys.argv[1]) if len(sys.argv) == 2 else None
+    server, *local = await start_servers(handle_request, 0, socks)
     addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
     print(f'announcer serving on {addrs}')
 
-    if len(sys.argv) == 2:
-        pid = sys.argv[1]
-        port = server.sockets[0].getsockname()[1]
-        stmp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        stmp.connect(("localhost", 42922))
-        stmp.send(f"PORT {pid} {port}".encode())
-
     async with server:
         await server.serve_forever()
 
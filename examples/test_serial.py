@@ -5,8 +5,7 @@ serial = SerialProxy(('192.168.107.58', 42922))
 message = serial._echo('hello!')
 print(message)
 ser = serial.Serial('COM3')
-ser.write(b'0in\r\n')
-ans = ser.read_until()
+ans = ser.query(b'0in\r\n')
 print(ans)
 ser.write(b'0fw\r\n')
 
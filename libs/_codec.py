@@ -0,0 +1,205 @@
+""" Typed binary encoding of the arguments and return values of proxy calls.
+
+Every value starts with a one byte tag, followed by its data in network byte
+order:
+
+    N           None
+    T, F        True, False
+    i   q       integer that fits in 64 bits
+    I   I + n   longer integer, n bytes of two's complement
+    d   d       float, kept as a double
+    b   I + n   bytes, bytearray or memoryview
+    s   I + n   str, utf-8
+    l   I + ... list, followed by its items
+    t   I + ... tuple, followed by its items
+    m   I + ... dict, followed by its keys and values
+    a   ...     numpy array: dtype and shape as a tuple, then the raw data
+
+pack(*values) concatenates the encoded values and unpack(data) returns them as
+a list, so the arguments of a call go in a single payload. numpy is only
+imported when an array is received.
+"""
+import struct
+
+_q = struct.Struct('>q')
+_d = struct.Struct('>d')
+_I = struct.Struct('>I')
+_tagged_q = struct.Struct('>cq')
+_tagged_d = struct.Struct('>cd')
+
+def _pack_int(value, out):
+    if -1 << 63 <= value < 1 << 63:
+        out += _tagged_q.pack(b'i', value)
+    else:
+        n = (value.bit_length() + 8) // 8
+        out += b'I'
+        out += _I.pack(n)
+        out += value.to_bytes(n, 'big', signed=True)
+
+def _pack_bytes(value, out):
+    out += b'b'
+    out += _I.pack(len(value))
+    out += value
+
+def _pack_str(value, out):
+    value = value.encode()
+    out += b's'
+    out += _I.pack(len(value))
+    out += value
+
+def _pack_items(tag):
+    def pack_items(value, out):
+        out += tag
+        out += _I.pack(len(value))
+        for item in value:
+            _pack(item, out)
+    return pack_items
+
+def _pack_dict(value, out):
+    out += b'm'
+    out += _I.pack(len(value))
+    for key, item in value.items():
+        _pack(key, out)
+        _pack(item, out)
+
+def _pack_float(value, out):
+    out += _tagged_d.pack(b'd', value)
+
+def _pack_array(value, out):
+    value = value.__array__()
+    if not value.flags.c_contiguous:
+        value = value.copy()
+    out += b'a'
+    _pack((value.dtype.str, value.shape), out)
+    _pack_bytes(value.data.cast('B'), out)
+
+_packers = {
+    type(None): lambda value, out: out.extend(b'N'),
+    bool: lambda value, out: out.extend(b'T' if value else b'F'),
+    int: _pack_int,
+    float: _pack_float,
+    bytes: _pack_bytes,
+    bytearray: _pack_bytes,
+    memoryview: lambda value, out: _pack_bytes(value.cast('B'), out),
+    str: _pack_str,
+    list: _pack_items(b'l'),
+    tuple: _pack_items(b't'),
+    dict: _pack_dict,
+}
+
+def _pack(value, out):
+    try:
+        packer = _packers[type(value)]
+    except KeyError:
+        if hasattr(value, '__array__') and hasattr(value, 'dtype'):
+            if value.shape == ():
+                # numpy scalars travel as plain python values
+                return _pack(value.item(), out)
+            packer = _pack_array
+        else:
+            packer = _packer_of_base(type(value))
+    packer(value, out)
+
+def _packer_of_base(cls):
+    for base in cls.__mro__[1:]:
+        if base in _packers:
+            return _packers[base]
+    raise TypeError(f'can not pack {cls.__name__}')
+
+def pack(*values):
+    """ Encode values into one payload. """
+    if len(values) == 1 and type(values[0]) is float:
+        # the common case of a setpoint or a reading
+        return _tagged_d.pack(b'd', values[0])
+    out = bytearray()
+    for value in values:
+        _pack(value, out)
+    return bytes(out)
+
+def _unpack_sized(data, i):
+    n, = _I.unpack_from(data, i)
+    i += 4
+    return data[i:i + n], i + n
+
+def _unpack_items(data, i):
+    n, = _I.unpack_from(data, i)
+    i += 4
+    items = []
+    for _ in range(n):
+        item, i = _unpack(data, i)
+        items.append(item)
+    return items, i
+
+def _unpack_long(data, i):
+    raw, i = _unpack_sized(data, i)
+    return int.from_bytes(raw, 'big', signed=True), i
+
+def _unpack_bytes(data, i):
+    raw, i = _unpack_sized(data, i)
+    return bytes(raw), i
+
+def _unpack_str(data, i):
+    raw, i = _unpack_sized(data, i)
+    return str(raw, 'utf-8'), i
+
+def _unpack_tuple(data, i):
+    items, i = _unpack_items(data, i)
+    return tuple(items), i
+
+def _unpack_dict(data, i):
+    n, = _I.unpack_from(data, i)
+    i += 4
+    value = {}
+    for _ in range(n):
+        key, i = _unpack(data, i)
+        value[key], i = _unpack(data, i)
+    return value, i
+
+def _unpack_array(data, i):
+    import numpy
+
+    (dtype, shape), i = _unpack(data, i)
+    raw, i = _unpack_sized(data, i + 1)
+    return numpy.frombuffer(bytearray(raw), dtype).reshape(shape), i
+
+_unpackers = {
+    ord('N'): lambda data, i: (None, i),
+    ord('T'): lambda data, i: (True, i),
+    ord('F'): lambda data, i: (False, i),
+    ord('i'): lambda data, i: (_q.unpack_from(data, i)[0], i + 8),
+    ord('I'): _unpack_long,
+    ord('d'): lambda data, i: (_d.unpack_from(data, i)[0], i + 8),
+    ord('b'): _unpack_bytes,
+    ord('s'): _unpack_str,
+    ord('l'): _unpack_items,
+    ord('t'): _unpack_tuple,
+    ord('m'): _unpack_dict,
+    ord('a'): _unpack_array,
+}
+
+def _unpack(data, i):
+    try:
+        unpacker = _unpackers[data[i]]
+    except KeyError:
+        raise ValueError(f'unknown tag {data[i:i + 1]!r}') from None
+    return unpacker(data, i + 1)
+
+def unpack(data):
+    """ Decode all values of a payload.
+
+    Returns:
+        (list) the values given to pack()
+    """
+    values = []
+    i = 0
+    while i < len(data):
+        value, i = _unpack(data, i)
+        values.append(value)
+    return values
+
+def unpack_value(data):
+    """ Decode a payload holding a single value, an empty payload is None. """
+    if not data:
+        return None
+    value, i = _unpack(data, 0)
+    return value
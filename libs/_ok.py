@@ -1,22 +1,55 @@
-import socket
+import os
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
 
-def _comm(data, host=('localhost', 4292), timeout=10):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect(host)
-    s.settimeout(timeout)
-    s.send(data)
-    r = s.recv(1024)
-    return r 
+from srd.libs._rpc import (AsyncProxy, Dispatcher, Proxy, _acomm, _comm,
+                           endpoint, inherit, is_local, listen, serve)
 
+class PipeBuffer(object):
+    """ Shared memory holding data for a pipe transfer to a server on the 
+    same machine.
 
-class OKProxy(object):
+    Fill buf and pass the PipeBuffer to WriteToPipeIn, then only the name and 
+    length of the buffer go over the connection and the server hands the 
+    shared memory to the FrontPanel pipe call without copying it:
+
+        pb = PipeBuffer(len(waveform))
+        pb.buf[:] = waveform
+        xem.WriteToPipeIn(0x80, pb)
+
+    The buffer is freed by close() or when the PipeBuffer is collected.
+    """
+    def __init__(self, size):
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.buf = self._shm.buf[:size]
+
+    def __len__(self):
+        return len(self.buf)
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def close(self):
+        if self._shm is not None:
+            self.buf.release()
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+class OKProxy(Proxy):
     def __init__(self, inithost=('localhost', 4292)):
         self._inithost = inithost
-        r = _comm('START libs _ok.py'.encode(), inithost)
-        self._libhost = inithost[0], int(r.decode())
+        r = _comm('START', b'libs _ok.py', inithost)
+        self._host = endpoint(r, inithost)
 
     def __del__(self):
-        r = _comm(f'STOP {self._libhost[1]}'.encode(), self._inithost)
+        r = _comm('STOP', f'{self._host[0]} {self._host[1]}'.encode(),
+                  self._inithost)
 
 
     def okCFrontPanel(self):
@@ -34,7 +67,7 @@ class OKProxy(object):
         5. Perform any application-specific communication with the FPGA using the 
         FPGA Communication methods.    
         """
-        return okFrontPanelProxy(self._libhost)
+        return okCFrontPanelProxy(self._host)
 
     def okCFrontPanelDevices(self, realm=''):
         """ Enumerates all the devices available in the given realm. 
@@ -44,9 +77,9 @@ class OKProxy(object):
         the okFP_REALM environment variable is used or, if this variable is not 
         defined, the "local" realm.
         """
-        return okCFrontPanelDevicesProxy(self._libhost, realm)
+        return okCFrontPanelDevicesProxy(self._host, realm)
 
-class okCFrontPanelDevicesProxy(object):
+class okCFrontPanelDevicesProxy(Proxy):
     """ Enumerates all the devices available in the given realm. 
    
     The realm of the devices represented by this object. By default, i.e. if 
@@ -60,14 +93,12 @@ class okCFrontPanelDevicesProxy(object):
 
     def GetCount(self):
         """ Returns the number of available devices, possibly 0. """
-        r = _comm(f'GetCount'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanelDevices.GetCount')
 
     def GetSerial(self, num=None):
         """ Returns the serial number of the given device, possibly empty if the 
         index is invalid."""
-        r = _comm(f'GetSerial {num}'.encode(), self._host)
-        return r.decode()
+        return self._call('okCFrontPanelDevices.GetSerial', num)
 
     def Open(self, serial=None):
         """ Opens the device with the given serial number, first one by default. 
@@ -75,10 +106,10 @@ class okCFrontPanelDevicesProxy(object):
         Returns an empty pointer if there is no such device (or no devices at 
         all if the serial is empty).
         """
-        r = _comm(f'Open {serial}'.encode(), self._host)
-        return okCFrontPanelProxy(self._host)
+        return self._call('okCFrontPanelDevices.Open', serial,
+                          decode=lambda r: okCFrontPanelProxy(self._host))
 
-class okCFrontPanelProxy(object):
+class okCFrontPanelProxy(Proxy):
     """ This class is the workhorse of the FrontPanel API. 
     
     It's methods are organized into three main groups: Device Interaction, 
@@ -93,9 +124,34 @@ class okCFrontPanelProxy(object):
     5. Perform any application-specific communication with the FPGA using the 
     FPGA Communication methods.    
     """
+    _pipe_buffer = None
+
     def __init__(self, host):
         self._host = host
 
+    def Batch(self, ops):
+        """ Runs several wire and trigger calls in a single round trip.
+
+        The calls are executed back to back on the server, without requests 
+        from other clients in between, and stop at the first one that fails. 
+        A typical use is to set a number of WireIns and commit them:
+
+            xem.Batch([('SetWireInValue', (0x00, 0x1234)),
+                       ('SetWireInValue', (0x01, 0x5678, 0xff)),
+                       ('UpdateWireIns', ()),
+                       ('UpdateWireOuts', ()),
+                       ('GetWireOutValue', (0x20,))])
+
+        Args:
+            ops (list): (name, args) pairs, where name is one of 
+                GetWireInValue, GetWireOutValue, IsTriggered, SetWireInValue,
+                UpdateTriggerOuts, UpdateWireIns or UpdateWireOuts and args is
+                a tuple of their integer arguments.
+        Returns:
+            (list) the return value of each call
+        """
+        return self._call('okCFrontPanel.Batch', ops)
+
     def Close(self):
         """ Close the device.
     
@@ -103,7 +159,7 @@ class okCFrontPanelProxy(object):
         device at the system level, e.g. to allow another process to use it, 
         without destroying this object itself but keeping it to be reopened later.
         """
-        r = _comm(f'Close'.encode(), self._host)
+        return self._call('okCFrontPanel.Close')
 
     def ConfigureFPGA(self, strFilename):
         """ Download an FPGA configuration from a file.
@@ -112,8 +168,7 @@ class okCFrontPanelProxy(object):
             strFilename	(str): A string containing the filename of the 
                 configuration file.
         """
-        r = _comm(f'ConfigureFPGA {strFilename}'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanel.ConfigureFPGA', strFilename)
     
     def GetWireInValue(self, epAddr):
         """ Gets the value of a particular Wire In from the internal wire data 
@@ -122,8 +177,7 @@ class okCFrontPanelProxy(object):
         Args:
             epAddr (int): The WireIn address to query.
         """
-        r = _comm(f'GetWireInValue {epAddr}'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanel.GetWireInValue', epAddr)
     
     def GetWireOutValue(self, epAddr):
         """ Gets the value of a particular Wire Out from the internal wire data 
@@ -132,8 +186,7 @@ class okCFrontPanelProxy(object):
         Args:
             epAddr (int): The WireOut address to query.
         """
-        r = _comm(f'GetWireOutValue {epAddr}'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanel.GetWireOutValue', epAddr)
     
     def IsTriggered(self, epAddr, mask):
         """ Returns true if the trigger has been triggered.
@@ -146,8 +199,7 @@ class okCFrontPanelProxy(object):
             epAddr (int): The TriggerOut address to query.
             mask (int): A mask to apply to the trigger value.
         """
-        r = _comm(f'IsTriggered {epAddr} {mask}'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanel.IsTriggered', epAddr, mask)
 
     def SetWireInValue(self, epAddr, val, mask=0xffffffff):
         """ Sets a wire value in the internal wire data structure.
@@ -162,8 +214,7 @@ class okCFrontPanelProxy(object):
             val (int): The new value of the WireIn.
             mask (int): A mask to apply to the new value
         """
-        r = _comm(f'SetWireInValue {epAddr} {val} {mask}'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanel.SetWireInValue', epAddr, val, mask)
 
     def UpdateTriggerOuts(self):
         """ Reads Trigger Out endpoints. 
@@ -171,8 +222,7 @@ class okCFrontPanelProxy(object):
         This method is called to query the XEM to determine if any TriggerOuts 
         have been activated since the last call.
         """
-        r = _comm(f'UpdateTriggerOuts'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanel.UpdateTriggerOuts')
 
     def UpdateWireIns(self):
         """ Transfers current Wire In values to the FPGA.
@@ -183,8 +233,7 @@ class okCFrontPanelProxy(object):
         changes to the XEM simultaneously so that all wires will be updated at 
         the same time.
         """
-        r = _comm(f'UpdateWireIns'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanel.UpdateWireIns')
     
     def UpdateWireOuts(self):
         """ Transfers current Wire Out values from the FPGA.
@@ -192,103 +241,171 @@ class okCFrontPanelProxy(object):
         This method is called to request the current state of all WireOut values
         from the XEM. All wire outs are captured and read at the same time.
         """
-        r = _comm(f'UpdateWireOuts'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('okCFrontPanel.UpdateWireOuts')
 
     def WriteToPipeIn(self, epAddr, data):
         """ Writes a block to a Pipe In endpoint.
 
         Args:
             epAddr (int): The address of the destination Pipe In.
-            data (bytearray): Data to be transferred
+            data (bytearray): Data to be transferred, or a PipeBuffer
+        
+        Data for a server on the same machine is staged in shared memory 
+        instead of being sent over the connection.
         """ 
-        r = _comm(f'WriteToPipeIn {epAddr} '.encode() + data, self._host)
-        return int.from_bytes(r, 'big')
+        if isinstance(data, PipeBuffer):
+            name, length, decode = data.name, len(data), None
+        elif is_local(self._host):
+            # the buffer is reused by the next transfer once the server is
+            # done with this one, concurrent transfers stage separately
+            pb, self._pipe_buffer = self._pipe_buffer, None
+            if pb is None or len(pb) < len(data):
+                pb = PipeBuffer(len(data))
+            pb.buf[:len(data)] = data
+            name, length = pb.name, len(data)
+
+            def decode(r):
+                self._pipe_buffer = pb
+                return r
+        else:
+            return self._call('okCFrontPanel.WriteToPipeIn', epAddr, data)
+        return self._call('okCFrontPanel.WriteToPipeInShared', epAddr, name,
+                          length, decode=decode)
+
+class AsyncOKProxy(AsyncProxy, OKProxy):
+    """ asyncio counterpart of OKProxy.
+
+    Start it with `ok = await AsyncOKProxy.start(inithost)`. The server is not
+    stopped when the proxy is garbage collected, call `await ok.stop()` when
+    done with it.
+    """
+    def __init__(self, inithost, host):
+        self._inithost = inithost
+        self._host = host
+
+    @classmethod
+    async def start(cls, inithost=('localhost', 4292)):
+        r = await _acomm('START', b'libs _ok.py', inithost)
+        return cls(inithost, endpoint(r, inithost))
+
+    def __del__(self):
+        pass
+
+    async def stop(self):
+        """ Stop the server. """
+        await _acomm('STOP', f'{self._host[0]} {self._host[1]}'.encode(),
+                     self._inithost)
 
-def consume(data, sep=" "):
-    action, _, data = data.partition(sep)
-    return action
+    def okCFrontPanel(self):
+        return AsyncokCFrontPanelProxy(self._host)
+
+    def okCFrontPanelDevices(self, realm=''):
+        return AsyncokCFrontPanelDevicesProxy(self._host, realm)
+
+class AsyncokCFrontPanelDevicesProxy(AsyncProxy, okCFrontPanelDevicesProxy):
+    """ asyncio counterpart of okCFrontPanelDevicesProxy. """
+    async def Open(self, serial=None):
+        await super().Open(serial)
+        return AsyncokCFrontPanelProxy(self._host)
+
+class AsyncokCFrontPanelProxy(AsyncProxy, okCFrontPanelProxy):
+    """ asyncio counterpart of okCFrontPanelProxy. """
 
-def handle_request(conn):
-    global devs
+# xem methods taking and returning integers, these can also be batched
+_int_methods = ("GetWireInValue", "GetWireOutValue", "IsTriggered",
+                "SetWireInValue", "UpdateTriggerOuts", "UpdateWireIns",
+                "UpdateWireOuts")
+
+_attached = OrderedDict()
+
+def _attach(name):
+    """ Shared memory of a client PipeBuffer, the last few stay mapped. """
+    if name in _attached:
+        _attached.move_to_end(name)
+    else:
+        shm = shared_memory.SharedMemory(name)
+        if os.name == "posix":
+            # the client owns the buffer, keep the resource tracker of this
+            # process from unlinking it at exit
+            resource_tracker.unregister(shm._name, "shared_memory")
+        _attached[name] = shm
+        while len(_attached) > 4:
+            _attached.popitem(last=False)[1].close()
+    return _attached[name]
+
+server = Dispatcher()
+
+# the device list and the open device are locked separately, Open queues
+# behind the device it replaces
+@server.register("okCFrontPanelDevices.GetCount", "devices")
+def _get_count():
+    return devices.GetCount()
+
+@server.register("okCFrontPanelDevices.GetSerial", "devices")
+def _get_serial(num):
+    return devices.GetSerial(num)
+
+@server.register("okCFrontPanelDevices.Open", "xem")
+def _open(serial):
     global xem
-    data = conn.recv(1024)
-    action = consume(data) 
-
-    if action == b"okCFrontPanelDevices.GetCount":
-        count = devices.GetCount()
-        conn.send(count.to_bytes(4, "big"))
-    elif action == b"okCFrontPanelDevices.GetSerial":
-        num = int(consume(data))
-        serial = devices.GetSerial(num)
-        conn.send(serial.encode())
-    elif action == b"okCFrontPanelDevices.Open":
-        serialb = consume(data)
-        serial = serialb.decode() if serialb != b"None" else None
-        xem = devices.Open(serial)
-        conn.send(b"")
-    elif action == b"okCFrontPanel.Close":
-        xem.Close()
-        conn.send(b"")
-    elif action == b"okCFrontPanel.ConfigureFPGA":
-        strFilename = consume(data).decode()
-        err = xem.ConfigureFPGA(strFilename)
-        conn.send(err.to_bytes(4, "big"))
-    elif action == b"okCFrontPanel.GetWireInValue":
-        epAddr = int(consume(data))
-        val = xem.GetWireInValue(epAddr)
-        conn.send(val.to_bytes(4, "big"))
-    elif action == b"okCFrontPanel.GetWireOutValue":
-        epAddr = int(consume(data))
-        val = xem.GetWireOutValue(epAddr)
-        conn.send(val.to_bytes(4, "big"))
-    elif action == b"okCFrontPanel.IsTriggered":
-        epAddr = int(consume(data))
-        mask = int(consume(data))
-        val = xem.IsTriggered(epAddr, mask)
-        conn.send(val.to_bytes(4, "big"))
-    elif action == b"okCFrontPanel.SetWireInValue":
-        epAddr = int(consume(data))
-        val = int(consume(data))
-        mask = int(consume(data))
-        err = xem.SetWireInValue(epAddr, val, mask)
-        conn.send(err.to_bytes(4, "big"))
-    elif action == b"okCFrontPanel.UpdateTriggerOuts":
-        err = xem.UpdateTriggerOuts()
-        conn.send(err.to_bytes(4, "big"))
-    elif action == b"okCFrontPanel.UpdateWireIns":
-        err = xem.UpdateWireIns()
-        conn.send(err.to_bytes(4, "big"))
-    elif action == b"okCFrontPanel.UpdateWireOuts":
-        err = xem.UpdateWireOuts()
-        conn.send(err.to_bytes(4, "big"))
-    elif action == b"okCFrontPanel.WriteToPipeIn":
-        epAddr = int(consume(data))
-        err = xem.SetWireInValue(epAddr, data)
-        conn.send(err.to_bytes(4, "big"))
+    xem = devices.Open(serial)
+
+@server.register("okCFrontPanel.Batch", "xem")
+def _batch(ops):
+    results = []
+    for name, args in ops:
+        if name not in _int_methods:
+            raise ValueError(f"{name} can not be batched")
+        results.append(int(getattr(xem, name)(*args)))
+    return results
+
+@server.register("okCFrontPanel.Close", "xem")
+def _close():
+    xem.Close()
+
+@server.register("okCFrontPanel.ConfigureFPGA", "xem")
+def _configure_fpga(strFilename):
+    return xem.ConfigureFPGA(strFilename)
+
+def _register_int_method(name):
+    def handler(*args):
+        return int(getattr(xem, name)(*args))
+
+    server.register(f"okCFrontPanel.{name}", "xem")(handler)
+
+for name in _int_methods:
+    _register_int_method(name)
+
+@server.register("okCFrontPanel.WriteToPipeIn", "xem")
+def _write_to_pipe_in(epAddr, data):
+    return xem.WriteToPipeIn(epAddr, bytearray(data))
+
+@server.register("okCFrontPanel.WriteToPipeInShared", "xem")
+def _write_to_pipe_in_shared(epAddr, name, length):
+    with _attach(name).buf[:length] as data:
+        try:
+            return xem.WriteToPipeIn(epAddr, data)
+        except TypeError:
+            # FrontPanel bindings that only take a bytearray
+            return xem.WriteToPipeIn(epAddr, bytearray(data))
 
 if __name__ == "__main__":
     import logging
     import ok
     import sys
     
-    devices = ok.okCFrontPanelDevices()
+    def open_devices():
+        global devices
+        devices = ok.okCFrontPanelDevices()
+
+    # enumerating the devices can take seconds, serve meanwhile
+    devices = None
     xem = None
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.open(open_devices)
 
     if len(sys.argv) == 2:
-        s.bind(("0.0.0.0", 0))
-        pid = sys.argv[1]
-        port = s.getsockname()[1]
-        stmp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        stmp.connect(("localhost", 42922))
-        stmp.send(f"PORT {pid} {port}".encode())
-        s.listen(1)
+        socks = inherit(sys.argv[1])
     else:
-        s.bind(("0.0.0.0", 65050))
-        s.listen(1)
+        socks = listen(65050)
 
-    while True:
-        conn, addr = s.accept()
-        handle_request(conn)
-        conn.close()
+    serve(socks, server, server.resource_of)
@@ -1,30 +1,24 @@
-import socket
 
-def _comm(data, host=('localhost', 4292), timeout=10):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect(host)
-    s.settimeout(timeout)
-    s.send(data)
-    r = s.recv(1024)
-    return r 
+from srd.libs._rpc import (AsyncProxy, Dispatcher, Proxy, _acomm, _comm,
+                           endpoint, inherit, listen, serve)
 
-class PyvisaProxy(object):
+class PyvisaProxy(Proxy):
     def __init__(self, inithost=('localhost', 4292)):
         self._inithost = inithost
-        r = _comm('START libs _pyvisa.py'.encode(), inithost)
-        self._libhost = inithost[0], int(r.decode())
+        r = _comm('START', b'libs _pyvisa.py', inithost)
+        self._host = endpoint(r, inithost)
 
     def __del__(self):
-        r = _comm(f'STOP {self._libhost[1]}'.encode(), self._inithost)
+        r = _comm('STOP', f'{self._host[0]} {self._host[1]}'.encode(),
+                  self._inithost)
 
     def _echo(self, message):
-        r = _comm(f'_echo {message}'.encode(), self._libhost)
-        return r.decode()
+        return self._call('_echo', message)
 
     def ResourceManager(self):
-        return ResourceManagerProxy(self._libhost)
+        return ResourceManagerProxy(self._host)
 
-class ResourceManagerProxy(object):
+class ResourceManagerProxy(Proxy):
     def __init__(self, host):
         self._host = host
 
@@ -36,8 +30,7 @@ class ResourceManagerProxy(object):
         Returns:
             (tuple) connected devices matching query
         """
-        r = _comm(f'list_resources {query}'.encode(), self._host)
-        return r.decode()
+        return self._call('list_resources', query)
 
     def open_resource(self, resource_name, open_timeout=0, **kwargs):
         """ Return an instrument for the resource name.
@@ -54,14 +47,12 @@ class ResourceManagerProxy(object):
         Returns:    
             Subclass of Resource matching the resource.
         """
-        r = _comm(f'open_resource {resource_name} {open_timeout} {kwargs}'.encode(),
-                  self._host)
-        if 'GPIB' in resource_name:
-            return GPIBInstrumentProxy(self._host, resource_name)
-        else:
+        if 'GPIB' not in resource_name:
             raise Exception('resource type not supported :(')
+        return self._call('open_resource', resource_name, open_timeout, kwargs,
+            decode=lambda r: GPIBInstrumentProxy(self._host, resource_name))
 
-class GPIBInstrumentProxy(object):
+class GPIBInstrumentProxy(Proxy):
     def __init__(self, host, resource_name):
         self._host = host
         self._resource_name = resource_name
@@ -78,8 +69,7 @@ class GPIBInstrumentProxy(object):
         Returns:    
             Return value of the library call.
         """
-        r = _comm(f'control_ren {mode}'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('control_ren', mode)
 
     def query(self, message, delay=None):
         """A combination of write(message) and read()
@@ -91,8 +81,7 @@ class GPIBInstrumentProxy(object):
         Returns:
             (str) the answer from the device.
         """
-        r = _comm(f'query {message} {delay}'.encode(), self._host)
-        return r.decode()
+        return self._call('query', message, delay)
 
     def read(self, termination=None, encoding=None):
         """Read a string from the device.
@@ -111,19 +100,17 @@ class GPIBInstrumentProxy(object):
         Returns:
             (str) output from device
         """
-        r = _comm(f'read {termination} {encoding}'.encode(), self._host)
-        return r.decode()
+        return self._call('read', termination, encoding)
 
     @property
     def timeout(self):
         """ The timeout in milliseconds for all resource I/O operations. """
-        r = _comm(f'timeout_getattr'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self.get('timeout')
 
     @timeout.setter
     def timeout(self, timeout):
         """ The timeout in milliseconds for all resource I/O operations. """
-        _comm(f'timeout_setattr {timeout}'.encode(), self._host)
+        return self._call('timeout_setattr', timeout)
 
     def write(self, message, termination=None, encoding=None):
         """ Write a string message to the device.
@@ -137,80 +124,102 @@ class GPIBInstrumentProxy(object):
         Returns:
             (int) number of bytes written
         """
-        r = _comm(f'write {message} {termination} {encoding}'.encode(),
-                  self._host)
-        return int.from_bytes(r, 'big')
+        return self._call('write', message, termination, encoding)
 
-def handle_request(conn):
-    global rm
+class AsyncPyvisaProxy(AsyncProxy, PyvisaProxy):
+    """ asyncio counterpart of PyvisaProxy.
+
+    Start it with `pyvisa = await AsyncPyvisaProxy.start(inithost)`. The
+    server is not stopped when the proxy is garbage collected, call
+    `await pyvisa.stop()` when done with it.
+    """
+    def __init__(self, inithost, host):
+        self._inithost = inithost
+        self._host = host
+
+    @classmethod
+    async def start(cls, inithost=('localhost', 4292)):
+        r = await _acomm('START', b'libs _pyvisa.py', inithost)
+        return cls(inithost, endpoint(r, inithost))
+
+    def __del__(self):
+        pass
+
+    async def stop(self):
+        """ Stop the server. """
+        await _acomm('STOP', f'{self._host[0]} {self._host[1]}'.encode(),
+                     self._inithost)
+
+    def ResourceManager(self):
+        return AsyncResourceManagerProxy(self._host)
+
+class AsyncResourceManagerProxy(AsyncProxy, ResourceManagerProxy):
+    """ asyncio counterpart of ResourceManagerProxy. """
+    async def open_resource(self, resource_name, open_timeout=0, **kwargs):
+        await super().open_resource(resource_name, open_timeout, **kwargs)
+        return AsyncGPIBInstrumentProxy(self._host, resource_name)
+
+class AsyncGPIBInstrumentProxy(AsyncProxy, GPIBInstrumentProxy):
+    """ asyncio counterpart of GPIBInstrumentProxy. """
+
+server = Dispatcher()
+
+@server.register("_echo", resource=None)
+def _echo(message):
+    return message
+
+# the resource manager and the open instrument are locked separately, so
+# resources can be listed while a slow query is outstanding
+@server.register("list_resources", "rm")
+def _list_resources(query):
+    return rm.list_resources(query)
+
+@server.register("open_resource", "inst")
+def _open_resource(resource_name, open_timeout, kwargs):
     global inst
-    data = conn.recv(1024)
-    action, _, args = data.partition(b" ")
-    
-    if action == b"_echo":
-        conn.send(args)
-    elif action == b"list_resources":
-        query = args.decode()
-        resources = rm.list_resources(query)
-        conn.send(str(resources).encode())
-    elif action == b"open_resource":
-        split = args.split(b" ")
-        resource_name = split[0].decode()
-        open_timeout = int(split[1])
-        kwargs = eval(split[2])
-        inst = rm.open_resource(resource_name, open_timeout, **kwargs)
-        conn.send(b"")
-    elif action == b"control_ren":
-        mode = int(args)
-        inst.control_ren(mode)
-    elif action == b"query":
-        split = args.split(b" ")
-        message = split[0].decode()
-        delay = float(split[1]) if split[1] != b"None" else None
-        response = inst.query(message, delay)
-        conn.send(response.encode())
-    elif action == b"read":
-        split = args.split(b" ")
-        termination = split[0].decode() if split[0] != b"None" else None
-        encoding = split[1].decode() if split[1] != b"None" else None
-        response = inst.read(termination, encoding)
-        conn.send(response.encode())
-    elif action == b"timeout_getattr":
-        timeout = inst.timeout
-        conn.send(timeout.to_bytes(2, "big"))
-    elif action == b"timeout_setattr":
-        timeout = int(args)
-        inst.timeout = timeout
-    elif action == b"write":
-        split = args.split(b" ")
-        message = split[0].decode()
-        termination = split[1].decode() if split[1] != b"None" else None
-        encoding = split[2].decode() if split[2] != b"None" else None
-        num_bytes = inst.write(message, termination, encoding)
-        conn.send(num_bytes.to_bytes(4, "big"))
+    inst = rm.open_resource(resource_name, open_timeout, **kwargs)
+
+@server.register("control_ren", "inst")
+def _control_ren(mode):
+    return inst.control_ren(mode)
+
+@server.register("query", "inst")
+def _query(message, delay):
+    return inst.query(message, delay)
+
+@server.register("read", "inst")
+def _read(termination, encoding):
+    return inst.read(termination, encoding)
+
+@server.register("timeout_getattr", "inst")
+def _timeout_getattr():
+    return inst.timeout
+
+@server.register("timeout_setattr", "inst")
+def _timeout_setattr(timeout):
+    inst.timeout = timeout
+
+@server.register("write", "inst")
+def _write(message, termination, encoding):
+    return inst.write(message, termination, encoding)
 
 if __name__ == "__main__":
     import logging
     import pyvisa
     import sys
 
-    rm = pyvisa.ResourceManager()
+    def open_resource_manager():
+        global rm
+        rm = pyvisa.ResourceManager()
+
+    # finding the VISA library can take seconds, serve meanwhile
+    rm = None
     inst = None
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.open(open_resource_manager)
 
     if len(sys.argv) == 2:
-        s.bind(("0.0.0.0", 0))
-        pid = sys.argv[1]
-        port = s.getsockname()[1]
-        stmp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        stmp.connect(("localhost", 42922))
-        stmp.send(f"PORT {pid} {port}".encode())
-        s.listen(1)
+        socks = inherit(sys.argv[1])
     else:
-        s.bind(("0.0.0.0", 65050))
-        s.listen(1)
+        socks = listen(65050)
 
-    while True:
-        conn, addr = s.accept()
-        handle_request(conn)
-        conn.close()
+    serve(socks, server, server.resource_of)
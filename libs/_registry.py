@@ -0,0 +1,111 @@
+""" Client-side cache of the hosts of the servers started with ENSURE.
+
+A server started with ENSURE keeps its host and port for as long as the
+supervisor runs, even across restarts, so they are asked for once per process
+and looked up in a dictionary afterwards. When SRD_REGISTRY names a file, they
+are also kept there for SRD_REGISTRY_TTL seconds, which spares new processes
+the round trip as well. Such a port may belong to another server after the
+supervisor restarted, so new connections to a resolved host first check with
+_ready that it serves the module, see _rpc.expect(). A proxy that can not
+connect to its server, or finds another one there, calls forget() and
+resolves the module again.
+"""
+import json
+import os
+import threading
+import time
+
+from srd import module_of
+from srd.libs._rpc import _acomm, _comm, endpoint, expect, unexpect
+
+REGISTRY = os.environ.get('SRD_REGISTRY')
+TTL = float(os.environ.get('SRD_REGISTRY_TTL', 3600))
+
+_hosts = {}
+_lock = threading.Lock()
+
+def _key(module, inithost):
+    return f'{inithost[0]}:{inithost[1]} {module}'
+
+def _load():
+    try:
+        with open(REGISTRY) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save(entries):
+    tmp = f'{REGISTRY}.{os.getpid()}'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, REGISTRY)
+    except OSError:
+        pass
+
+def _lookup(key, module):
+    host = _hosts.get(key)
+    if host is None and REGISTRY:
+        *host, t = _load().get(key, (None, None, 0))
+        if host[0] is not None and time.time() - t < TTL:
+            host = _hosts[key] = tuple(host)
+            expect(host, module_of(module))
+        else:
+            host = None
+    return host
+
+def _remember(key, module, host):
+    expect(host, module_of(module))
+    with _lock:
+        _hosts[key] = host
+        if REGISTRY:
+            entries = _load()
+            entries[key] = *host, time.time()
+            _save(entries)
+
+def resolve(module, inithost, timeout=10):
+    """ Host of the server of module, started by the supervisor at inithost,
+    or by the node of its cluster that owns module, if it is not running.
+
+    Args:
+        module: (str) directory and file of the module, as in 'devs x.py',
+            or of an instance of it followed by its resource, as in
+            'libs _serial.py COM3', which a cluster may route to another node
+        inithost: (host, port) of the supervisor
+    Returns:
+        (tuple) (host, port) of the server
+    """
+    key = _key(module, inithost)
+    host = _lookup(key, module)
+    if host is None:
+        r = _comm('ENSURE', module.encode(), inithost, timeout)
+        host = endpoint(r, inithost)
+        _remember(key, module, host)
+    return host
+
+async def aresolve(module, inithost, timeout=10):
+    """ asyncio counterpart of resolve(). """
+    key = _key(module, inithost)
+    host = _lookup(key, module)
+    if host is None:
+        r = await _acomm('ENSURE', module.encode(), inithost, timeout)
+        host = endpoint(r, inithost)
+        _remember(key, module, host)
+    return host
+
+def forget(module, inithost):
+    """ Drop the cached host of module, once its server could not be
+    reached.
+    """
+    key = _key(module, inithost)
+    with _lock:
+        host = _hosts.pop(key, None)
+        if REGISTRY:
+            entries = _load()
+            entry = entries.pop(key, None)
+            if entry is not None:
+                _save(entries)
+                host = host or tuple(entry[:2])
+        # the port may go to a server of another module
+        if host is not None:
+            unexpect(host)
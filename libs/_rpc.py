@@ -0,0 +1,1079 @@
+""" Connection handling shared by the lib and device servers and their proxies.
+
+Every message on the wire is one frame: a fixed header followed by the action
+name and the payload. The header carries the frame kind, a request id and the
+length of both fields, so payloads of any size arrive as a single message and
+the action never has to be split off the payload again. A reply carries the id
+of the request it answers, so a client can have many requests in flight on
+one connection and match the replies as they arrive. Clients keep their
+connections open in a per-host pool, and servers keep serving a connection
+until the client hangs up, handling requests for different resources of the
+server concurrently. The asyncio client shares one connection per host
+between all coroutines of an event loop. Both ends time every call, see
+stats().
+
+Servers listen on a tcp port and, where the platform has them, on a unix
+socket named after that port. Clients connecting to a port on this machine
+use the unix socket when it is there, which saves the loopback tcp stack on
+every call, and fall back to tcp otherwise.
+
+A streaming request, see Dispatcher.stream(), is answered with any number of
+PUSH frames carrying its id, ended by a REPLY or ERROR frame. It has a
+connection of its own, which the client closes to end the stream early.
+
+    magic   2s  b'SR'
+    kind    B   REQUEST, REPLY, ERROR or PUSH
+    id      I   request id, echoed in the reply
+    action  H   length of the action name (utf-8)
+    payload I   length of the payload
+"""
+import asyncio
+import os
+import select
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from concurrent import futures
+
+from srd.libs._codec import pack, unpack, unpack_value
+from srd.libs._stats import Stats
+
+MAGIC = b'SR'
+REQUEST = 0
+REPLY = 1
+ERROR = 2
+PUSH = 3
+
+_header = struct.Struct('>2sBIHI')
+
+# payloads above this size are sent on their own instead of being joined
+# onto the header, so large transfers are not copied once more
+_JOIN_LIMIT = 1 << 16
+
+# servers started by the supervisor inherit the sockets it bound for them
+# through pass_fds, where there is such a thing, see inherit()
+PASS_FDS = os.name == 'posix'
+# line with which a server that binds its own sockets reports its port
+READY = 'srd port'
+
+_idle = {}
+_idle_lock = threading.Lock()
+
+client_stats = Stats()
+server_stats = Stats()
+
+# when the server process got going, for the startup profile of _ready;
+# libs/_worker.py resets it when it is handed a module
+started = time.perf_counter()
+
+# module the server at a host must run, checked on every new connection to
+# it, see expect()
+_expected = {}
+
+# seconds a new connection to a host given to expect() waits for its server
+# to be done opening, see Dispatcher.open()
+OPEN_TIMEOUT = 10
+
+class RemoteError(Exception):
+    """ Raised on the client when the server failed to handle a request. """
+
+class Unreachable(ConnectionError):
+    """ Raised when no connection to a server could be opened, or it runs
+    another module than expected, so the request was not sent.
+    """
+
+def _recvall(s, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = s.recv_into(view[pos:])
+        if not n:
+            raise ConnectionError('connection closed by peer')
+        pos += n
+    return buf
+
+def _pack(kind, rid, action, payload):
+    action = action.encode()
+    return _header.pack(MAGIC, kind, rid, len(action), len(payload)) + action
+
+def _unpack(header):
+    magic, kind, rid, action_size, payload_size = _header.unpack(header)
+    if magic != MAGIC:
+        raise ConnectionError(f'bad frame magic {bytes(magic)!r}')
+    return kind, rid, action_size, payload_size
+
+def send_frame(s, kind, rid, action, payload=b''):
+    """ Send one frame over socket s. """
+    head = _pack(kind, rid, action, payload)
+    if len(payload) > _JOIN_LIMIT:
+        s.sendall(head)
+        s.sendall(payload)
+    else:
+        s.sendall(head + payload)
+
+def recv_frame(s):
+    """ Receive one frame from socket s.
+
+    Returns:
+        (tuple) kind, request id, action (str) and payload (bytes)
+    """
+    kind, rid, action_size, payload_size = _unpack(_recvall(s, _header.size))
+    action = _recvall(s, action_size).decode()
+    return kind, rid, action, bytes(_recvall(s, payload_size))
+
+async def read_frame(reader):
+    """ Receive one frame from an asyncio stream. """
+    header = await reader.readexactly(_header.size)
+    kind, rid, action_size, payload_size = _unpack(header)
+    action = (await reader.readexactly(action_size)).decode()
+    return kind, rid, action, await reader.readexactly(payload_size)
+
+def write_frame(writer, kind, rid, action, payload=b''):
+    """ Queue one frame on an asyncio stream. """
+    writer.write(_pack(kind, rid, action, payload))
+    writer.write(payload)
+
+_LOCAL_NAMES = {'localhost', '127.0.0.1', '::1', socket.gethostname()}
+_SIOCGIFADDR = 0x8915
+_local_names = None
+
+def _interface_addresses():
+    """ Addresses of the network interfaces of this machine. """
+    addresses = set()
+    try:
+        addresses.update(info[4][0] for info in
+                         socket.getaddrinfo(socket.gethostname(), None))
+    except OSError:
+        pass
+    # the host name often resolves to loopback only on linux, which lists
+    # the addresses of its interfaces on request
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for _, name in socket.if_nameindex():
+                try:
+                    r = fcntl.ioctl(s.fileno(), _SIOCGIFADDR,
+                                    struct.pack('256s', name.encode()[:15]))
+                except OSError:
+                    # no ipv4 address
+                    continue
+                addresses.add(socket.inet_ntoa(r[20:24]))
+    return addresses
+
+def unix_path(port):
+    """ Path of the unix socket of the server listening on tcp port. """
+    return os.path.join(tempfile.gettempdir(), f'srd-{port}.sock')
+
+def unlink(port):
+    """ Remove the unix socket of the server on port, once it is gone. """
+    try:
+        os.unlink(unix_path(port))
+    except OSError:
+        pass
+
+def is_local(host):
+    """ Whether the server at host runs on this machine, addressed by name
+    or by the address of any of its interfaces.
+    """
+    global _local_names
+    if _local_names is None:
+        _local_names = _LOCAL_NAMES | _interface_addresses()
+    return host[0] in _local_names
+
+def _local_path(host):
+    if hasattr(socket, 'AF_UNIX') and is_local(host):
+        path = unix_path(host[1])
+        if os.path.exists(path):
+            return path
+
+def _connect(host, timeout):
+    path = _local_path(host)
+    if path is not None:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        try:
+            s.connect(path)
+            return s
+        except OSError:
+            # left behind by a server that is gone
+            s.close()
+    s = socket.create_connection(host, timeout)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return s
+
+def _result(kind, payload):
+    if kind == ERROR:
+        raise RemoteError(payload.decode())
+    return payload
+
+def expect(host, module):
+    """ Have new connections to host check, with _ready, that its server runs
+    module, and fail with Unreachable if it does not, and wait until the
+    server is done opening its hardware.
+
+    A port remembered from an earlier supervisor may belong to another server
+    by now, and a server restarted on the same port opens its hardware anew.
+    Pooled connections are checked once, when they are opened.
+    """
+    _expected[tuple(host)] = module
+
+def unexpect(host):
+    """ Stop checking the module of the server at host, see expect(). """
+    _expected.pop(tuple(host), None)
+
+def _opening(host, kind, payload):
+    """ Whether the server at host, which replied to _ready, is opening,
+    after checking that it runs the expected module.
+    """
+    module = _expected[host]
+    try:
+        state = unpack_value(_result(kind, payload))
+    except RemoteError:
+        state = {}
+    if state.get('module') != module:
+        raise Unreachable(
+            f'{host[0]}:{host[1]} serves {state.get("module")}, not {module}')
+    return state['state'] == 'opening'
+
+def _module_name():
+    path = os.path.abspath(sys.argv[0]) if sys.argv[0] else ''
+    directory = os.path.basename(os.path.dirname(path))
+    return f'{directory} {os.path.basename(path)}'
+
+class Connection(object):
+    """ A client connection on which many requests can be in flight.
+
+    submit() sends a request and returns its id without waiting for the
+    reply; result() waits for the reply to a given id. Replies to other
+    requests read in the meantime are kept until they are asked for, so
+    requests can be collected in any order and from several threads.
+    """
+    def __init__(self, host, timeout=10):
+        self.host = host
+        try:
+            self._sock = _connect(host, timeout)
+        except ConnectionError as e:
+            raise Unreachable(f'{host[0]}:{host[1]}: {e}') from e
+        self._send_lock = threading.Lock()
+        self._recv_lock = threading.Lock()
+        self._next_id = 0
+        self._replies = {}
+        if host in _expected:
+            try:
+                self._check(timeout)
+            except BaseException:
+                self.close()
+                raise
+
+    def _check(self, timeout):
+        deadline = time.monotonic() + OPEN_TIMEOUT
+        while _opening(self.host, *self._wait(self.submit('_ready'),
+                                              timeout)):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{self.host} is still opening')
+            time.sleep(0.05)
+
+    def close(self):
+        self._sock.close()
+
+    def submit(self, action, args=b''):
+        """ Send a request and return its id. """
+        with self._send_lock:
+            self._next_id = (self._next_id + 1) & 0xffffffff
+            rid = self._next_id
+            send_frame(self._sock, REQUEST, rid, action, args)
+        return rid
+
+    def _wait(self, rid, timeout):
+        while True:
+            with self._recv_lock:
+                if rid in self._replies:
+                    return self._replies.pop(rid)
+                self._sock.settimeout(timeout)
+                kind, rid_, _, payload = recv_frame(self._sock)
+                self._replies[rid_] = kind, payload
+
+    def result(self, rid, timeout=10):
+        """ Wait for the reply to request rid and return its payload.
+
+        Raises:
+            RemoteError: the server raised while handling the request.
+        """
+        return _result(*self._wait(rid, timeout))
+
+    def call(self, action, args=b'', timeout=10):
+        """ Send a request and wait for its reply payload. """
+        return self.result(self.submit(action, args), timeout)
+
+def _stale(c):
+    # an idle connection has nothing to read, unless the server closed it
+    try:
+        return bool(select.select([c._sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+def _checkout(host, timeout):
+    while True:
+        with _idle_lock:
+            idle = _idle.get(host)
+            if not idle:
+                break
+            c = idle.pop()
+        if not _stale(c):
+            return c, True
+        c.close()
+    return Connection(host, timeout), False
+
+def _checkin(host, c):
+    with _idle_lock:
+        _idle.setdefault(host, []).append(c)
+
+def pipeline(requests, host=('localhost', 4292), timeout=10):
+    """ Send several requests to host back to back and return the replies.
+
+    All requests are written before the first reply is read, so the batch
+    costs about one round trip instead of one per request.
+
+    A pooled connection the server has closed is replaced before anything is
+    sent on it. The requests are sent again only if the first of them could
+    not be written to a pooled connection, as then none of them reached the
+    server; otherwise some may have run, and ConnectionError is raised.
+
+    Args:
+        requests (list): (action, args) pairs.
+    Returns:
+        (list) reply payloads in the order of requests
+    Raises:
+        RemoteError: the server raised while handling one of the requests.
+        Unreachable: no connection to host could be opened.
+    """
+    t0 = time.perf_counter()
+    c, reused = _checkout(host, timeout)
+    if not reused:
+        client_stats.record(requests[0][0], 'connect',
+                            time.perf_counter() - t0)
+    sent = []
+    try:
+        for action, args in requests:
+            t0 = time.perf_counter()
+            rid = c.submit(action, args)
+            t1 = time.perf_counter()
+            client_stats.record(action, 'send', t1 - t0)
+            sent.append((action, rid, t1))
+        replies = []
+        for action, rid, t1 in sent:
+            kind, payload = c._wait(rid, timeout)
+            client_stats.record(action, 'reply', time.perf_counter() - t1)
+            if kind == ERROR:
+                client_stats.error(action)
+            replies.append((kind, payload))
+    except ConnectionError:
+        c.close()
+        if not reused or sent:
+            raise
+        return pipeline(requests, host, timeout)
+    except BaseException:
+        c.close()
+        raise
+    _checkin(host, c)
+    return [_result(kind, payload) for kind, payload in replies]
+
+def _comm(action, args=b'', host=('localhost', 4292), timeout=10):
+    """ Send one request to host and return the reply payload.
+
+    The connection is taken from the pool for host and put back once the
+    reply has been read, so consecutive calls reuse the same socket. A pooled
+    connection the server has since dropped is replaced, see pipeline().
+
+    Raises:
+        RemoteError: the server raised while handling the request.
+    """
+    return pipeline([(action, args)], host, timeout)[0]
+
+def stream(action, args=b'', host=('localhost', 4292), timeout=None):
+    """ Send a streaming request to host on a connection of its own and
+    yield the payloads the server pushes until it ends the stream.
+
+    Closing the generator hangs up, which ends the stream on the server.
+
+    Args:
+        timeout: (float) seconds to wait for the next payload, None waits
+            forever
+    Raises:
+        RemoteError: the server raised while streaming.
+    """
+    c = Connection(host)
+    try:
+        rid = c.submit(action, args)
+        c._sock.settimeout(timeout)
+        while True:
+            kind, _, _, payload = recv_frame(c._sock)
+            if kind != PUSH:
+                _result(kind, payload)
+                return
+            yield payload
+    finally:
+        c.close()
+
+def endpoint(reply, inithost):
+    """ (host, port) of a server from the reply of the supervisor at inithost
+    to START or ENSURE.
+
+    The reply is the port of the server, preceded by its host when the
+    supervisor had another node of the cluster start it. Whatever module was
+    expected at that host before is not there any more, see expect().
+    """
+    host, _, port = reply.decode().rpartition(' ')
+    host = host or inithost[0], int(port)
+    unexpect(host)
+    return host
+
+def close(host=None):
+    """ Close pooled connections to host, or to every host if None. """
+    with _idle_lock:
+        hosts = list(_idle) if host is None else [host]
+        for h in hosts:
+            for c in _idle.pop(h, []):
+                c.close()
+
+def stats(host=None, timeout=10):
+    """ Call counts and latencies of this client, or of the server at host.
+
+    The client times connecting, sending each request and waiting for its
+    reply. A server times the wait of each request for its resource, the
+    handler itself and sending the reply.
+
+    Returns:
+        (dict) {action: {'errors': n, stage: {'count', 'mean', 'p50', 'p99',
+        'max'}}} with durations in seconds
+    """
+    if host is None:
+        return client_stats.snapshot()
+    return unpack_value(_comm('STATS', b'', host, timeout))
+
+async def _aconnect(host, timeout):
+    path = _local_path(host)
+    if path is not None:
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_unix_connection(path), timeout)
+        except OSError:
+            pass
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(*host), timeout)
+    sock = writer.get_extra_info('socket')
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return reader, writer
+
+class AsyncConnection(object):
+    """ asyncio counterpart of Connection.
+
+    A reader task resolves the future of each request as its reply arrives,
+    so any number of coroutines can have requests in flight on one
+    connection. Create it with `await AsyncConnection.open(host)`.
+    """
+    def __init__(self, host, reader, writer):
+        self.host = host
+        self._reader = reader
+        self._writer = writer
+        self._next_id = 0
+        self._pending = {}
+        self._task = asyncio.ensure_future(self._read_replies())
+
+    @classmethod
+    async def open(cls, host, timeout=10):
+        try:
+            c = cls(host, *await _aconnect(host, timeout))
+        except ConnectionError as e:
+            raise Unreachable(f'{host[0]}:{host[1]}: {e}') from e
+        if host in _expected:
+            try:
+                await c._check(timeout)
+            except BaseException:
+                c.close()
+                raise
+        return c
+
+    async def _check(self, timeout):
+        deadline = time.monotonic() + OPEN_TIMEOUT
+        while True:
+            rid, fut = self.submit('_ready')
+            await self._writer.drain()
+            if not _opening(self.host, *await self._wait(rid, fut, timeout)):
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{self.host} is still opening')
+            await asyncio.sleep(0.05)
+
+    @property
+    def closed(self):
+        return self._task.done()
+
+    def close(self):
+        self._writer.close()
+        self._task.cancel()
+
+    async def _read_replies(self):
+        try:
+            while True:
+                kind, rid, _, payload = await read_frame(self._reader)
+                fut, action, t_sent = self._pending.pop(rid, (None,) * 3)
+                if fut is not None and not fut.done():
+                    client_stats.record(action, 'reply',
+                                        time.perf_counter() - t_sent)
+                    if kind == ERROR:
+                        client_stats.error(action)
+                    fut.set_result((kind, payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for fut, _, _ in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError('connection closed'))
+            self._pending.clear()
+
+    def submit(self, action, args=b''):
+        """ Queue a request and return a future for its reply. """
+        if self.closed:
+            raise ConnectionError('connection closed')
+        self._next_id = (self._next_id + 1) & 0xffffffff
+        rid = self._next_id
+        fut = asyncio.get_running_loop().create_future()
+        t0 = time.perf_counter()
+        write_frame(self._writer, REQUEST, rid, action, args)
+        t1 = time.perf_counter()
+        client_stats.record(action, 'send', t1 - t0)
+        self._pending[rid] = fut, action, t1
+        return rid, fut
+
+    async def _wait(self, rid, fut, timeout):
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self._pending.pop(rid, None)
+
+    async def call(self, action, args=b'', timeout=10):
+        """ Send a request and wait for its reply payload.
+
+        Raises:
+            RemoteError: the server raised while handling the request.
+        """
+        rid, fut = self.submit(action, args)
+        await self._writer.drain()
+        return _result(*await self._wait(rid, fut, timeout))
+
+_async_pool = weakref.WeakKeyDictionary()
+
+async def _aconnection(host, timeout, action):
+    conns = _async_pool.setdefault(asyncio.get_running_loop(), {})
+    c = conns.get(host)
+    if c is None or c.done() and (c.cancelled() or c.exception() is not None
+                                  or c.result().closed):
+        c = asyncio.ensure_future(_aopen(host, timeout, action))
+        conns[host] = c
+    return await asyncio.shield(c)
+
+async def _aopen(host, timeout, action):
+    t0 = time.perf_counter()
+    c = await AsyncConnection.open(host, timeout)
+    client_stats.record(action, 'connect', time.perf_counter() - t0)
+    return c
+
+async def apipeline(requests, host=('localhost', 4292), timeout=10):
+    """ asyncio counterpart of pipeline(). """
+    c = await _aconnection(host, timeout, requests[0][0])
+    pending = [c.submit(action, args) for action, args in requests]
+    await c._writer.drain()
+    replies = await asyncio.gather(*(c._wait(rid, fut, timeout)
+                                     for rid, fut in pending))
+    return [_result(kind, payload) for kind, payload in replies]
+
+async def _acomm(action, args=b'', host=('localhost', 4292), timeout=10):
+    """ asyncio counterpart of _comm().
+
+    All coroutines of an event loop share one connection per host, on which
+    their requests are multiplexed.
+    """
+    c = await _aconnection(host, timeout, action)
+    return await c.call(action, args, timeout)
+
+async def astream(action, args=b'', host=('localhost', 4292), timeout=None):
+    """ asyncio counterpart of stream(), an async generator. """
+    reader, writer = await _aconnect(host, 10)
+    try:
+        write_frame(writer, REQUEST, 1, action, args)
+        await writer.drain()
+        while True:
+            kind, _, _, payload = await asyncio.wait_for(read_frame(reader),
+                                                         timeout)
+            if kind != PUSH:
+                _result(kind, payload)
+                return
+            yield payload
+    except asyncio.IncompleteReadError:
+        raise ConnectionError('connection closed by peer') from None
+    finally:
+        writer.close()
+
+async def aclose(host=None):
+    """ asyncio counterpart of close(), for the connections of the running
+    event loop.
+    """
+    conns = _async_pool.get(asyncio.get_running_loop(), {})
+    for h in list(conns) if host is None else [host]:
+        c = conns.pop(h, None)
+        if (c is not None and c.done() and not c.cancelled()
+                and c.exception() is None):
+            c.result().close()
+
+class Proxy(object):
+    """ Base of the client proxies, which send their requests to self._host.
+
+    Methods hand their action and arguments to _call(), and properties read
+    through get(), so that AsyncProxy can turn any proxy into its asyncio
+    counterpart by overriding those two. Arguments and return values travel
+    encoded by _codec. Attributes are read with the action
+    _prefix + name + '_getattr'.
+    """
+    _prefix = ''
+    _timeout = 10
+
+    def _ready(self):
+        """ Whether the server has opened its hardware, see
+        Dispatcher.open().
+        """
+        return self._call('_ready')
+
+    def _call(self, action, *args, decode=None):
+        r = unpack_value(_comm(action, pack(*args), self._host, self._timeout))
+        return r if decode is None else decode(r)
+
+    def _stream(self, action, *args):
+        """ Generator of the values the server pushes for a streaming
+        action, see Dispatcher.stream().
+        """
+        for payload in stream(action, pack(*args), self._host):
+            yield unpack_value(payload)
+
+    def _getattr_requests(self, names):
+        return [(f'{self._prefix}{name}_getattr', b'') for name in names]
+
+    def _decode(self, names, replies):
+        values = [unpack_value(r) for r in replies]
+        return values[0] if len(names) == 1 else values
+
+    def get(self, *names):
+        """ Read one or more attributes in a single round trip.
+
+        Returns:
+            the value of the attribute if a single name is given, otherwise a
+            list of values in the order of names
+        """
+        replies = pipeline(self._getattr_requests(names), self._host,
+                           self._timeout)
+        return self._decode(names, replies)
+
+class AsyncProxy(Proxy):
+    """ Mixin that makes a proxy class awaitable.
+
+    Every method of the proxy returns an awaitable, and properties are read
+    with `await proxy.name` or `await proxy.get(name)`. Properties can not be
+    assigned to; use `await proxy.set(name, value)` instead.
+    """
+    async def _call(self, action, *args, decode=None):
+        r = unpack_value(
+            await _acomm(action, pack(*args), self._host, self._timeout))
+        return r if decode is None else decode(r)
+
+    async def _stream(self, action, *args):
+        async for payload in astream(action, pack(*args), self._host):
+            yield unpack_value(payload)
+
+    async def get(self, *names):
+        replies = await apipeline(self._getattr_requests(names), self._host,
+                                  self._timeout)
+        return self._decode(names, replies)
+
+    async def set(self, name, value):
+        """ Write a property. """
+        await getattr(type(self), name).fset(self, value)
+
+    def __setattr__(self, name, value):
+        if isinstance(getattr(type(self), name, None), property):
+            raise AttributeError(f'use await proxy.set({name!r}, value)')
+        object.__setattr__(self, name, value)
+
+def attributes(cls):
+    """ The properties of cls with a return annotation.
+
+    Returns:
+        (dict) (type, settable) of each property by name
+    """
+    attrs = {}
+    for name in dir(cls):
+        attr = getattr(cls, name)
+        if isinstance(attr, property):
+            annotation = getattr(attr.fget, '__annotations__', {})
+            if 'return' in annotation:
+                attrs[name] = annotation['return'], attr.fset is not None
+    return attrs
+
+def proxy_attributes(cls):
+    """ Proxy properties for the annotated properties of cls.
+
+    Returns:
+        (dict) class namespace with the properties, to build a proxy class
+        with type()
+    """
+    namespace = {}
+    for name, (kind, settable) in attributes(cls).items():
+        def fget(self, name=name):
+            return self.get(name)
+
+        def fset(self, value, name=name):
+            return self._call(f'{self._prefix}{name}_setattr', value)
+
+        namespace[name] = property(fget, fset if settable else None,
+                                   doc=getattr(cls, name).__doc__)
+    return namespace
+
+class Dispatcher(object):
+    """ Table of the actions handled by a server.
+
+    Handlers are called with the arguments the proxy passed to _call() and
+    their return value is sent back. A dispatcher is passed to serve() as
+    both handle_request and resource_of:
+
+        server = Dispatcher()
+
+        @server.register('_echo', resource=None)
+        def _echo(message):
+            return message
+
+        serve(socks, server, server.resource_of)
+
+    Hardware that is slow to open is opened with open(), which lets the
+    server answer before it is done. Actions that keep sending values are
+    registered with stream().
+    """
+    def __init__(self):
+        self._handlers = {}
+        self._streams = set()
+        self._resources = {}
+        self._opener = None
+        self._opened = threading.Event()
+        self._opened.set()
+        self._open_lock = threading.Lock()
+        self._ready = True
+        self._state = {'state': 'ready', 'error': None, 'import': None,
+                       'open': None, 'module': _module_name()}
+        self.register('_ready', resource=None)(lambda: dict(self._state))
+
+    def __call__(self, action, args):
+        try:
+            handler = self._handlers[action]
+        except KeyError:
+            raise ValueError(f'unknown action {action}') from None
+        if not self._ready and self._resources[action] is not None:
+            self._wait_opened()
+        if action in self._streams:
+            return self._packed(handler(*unpack(args)))
+        return pack(handler(*unpack(args)))
+
+    @staticmethod
+    def _packed(values):
+        try:
+            for value in values:
+                yield None if value is None else pack(value)
+        finally:
+            values.close()
+
+    def open(self, opener):
+        """ Call opener in a background thread, typically to open the
+        hardware.
+
+        The server answers right away. Requests for actions with a resource
+        wait for opener to return, and if it raised, they call it again
+        themselves. The _ready action reports the module the server runs, as
+        in 'devs x.py', the state, 'opening', 'ready' or 'failed', the error,
+        and how long the server took to import, up to this call, and to open,
+        in seconds.
+        """
+        self._opener = opener
+        self._ready = False
+        self._opened.clear()
+        self._state['state'] = 'opening'
+        self._state['import'] = time.perf_counter() - started
+        threading.Thread(target=self._open, daemon=True).start()
+
+    def _open(self):
+        with self._open_lock:
+            if self._ready:
+                return
+            t0 = time.perf_counter()
+            try:
+                self._opener()
+                self._state.update(state='ready', error=None)
+                self._ready = True
+            except Exception as e:
+                self._state.update(state='failed',
+                                   error=f'{type(e).__name__}: {e}')
+            self._state['open'] = time.perf_counter() - t0
+            self._opened.set()
+
+    def _wait_opened(self):
+        self._opened.wait()
+        if not self._ready:
+            # the hardware may be there by now
+            self._open()
+            if not self._ready:
+                raise RuntimeError(f"opening failed, {self._state['error']}")
+
+    def register(self, action, resource=''):
+        """ Decorator registering a handler for action.
+
+        resource may also be a function of the first argument of the request
+        returning the resource, for objects that come and go, such as the
+        ports of a server handling many.
+        """
+        def decorator(handler):
+            self._handlers[action] = handler
+            self._resources[action] = resource
+            return handler
+        return decorator
+
+    def stream(self, action):
+        """ Decorator registering a generator function as the handler of a
+        streaming action.
+
+        Each value the generator yields is pushed to the client as it comes,
+        until the generator returns or the client hangs up, which closes the
+        generator. It runs on the thread of the connection, not on a resource,
+        and should yield None when it has been idle for a while, which only
+        checks whether the client is still there.
+        """
+        def decorator(handler):
+            self._streams.add(action)
+            return self.register(action, resource=None)(handler)
+        return decorator
+
+    def expose(self, obj, resource='', prefix='', cls=None):
+        """ Register name_getattr and name_setattr for each annotated
+        property of obj. Values are converted to the annotated type.
+
+        An object that is only created later, by the opener given to open(),
+        is exposed by passing a function returning it as obj and its class
+        as cls.
+        """
+        get = (lambda: obj) if cls is None else obj
+        for name, (kind, settable) in attributes(cls or type(obj)).items():
+            def getattr_(name=name, kind=kind):
+                return kind(getattr(get(), name))
+
+            def setattr_(value, name=name, kind=kind):
+                setattr(get(), name, kind(value))
+
+            self.register(f'{prefix}{name}_getattr', resource)(getattr_)
+            if settable:
+                self.register(f'{prefix}{name}_setattr', resource)(setattr_)
+
+    def resource_of(self, action, args=b''):
+        resource = self._resources.get(action, '')
+        if callable(resource):
+            return resource(unpack_value(args))
+        return resource
+
+def _handle(handle_request, action, args):
+    try:
+        if action == 'STATS':
+            return REPLY, pack(server_stats.snapshot())
+        return REPLY, handle_request(action, args) or b''
+    except Exception as e:
+        server_stats.error(action)
+        return ERROR, f'{type(e).__name__}: {e}'.encode()
+
+def _hung_up(conn):
+    # a streaming client sends nothing more, readable means it closed
+    return bool(select.select([conn], [], [], 0)[0])
+
+def _push(conn, send_lock, rid, action, values):
+    try:
+        while True:
+            try:
+                kind, payload = PUSH, next(values)
+            except StopIteration:
+                kind, payload = REPLY, b''
+            except Exception as e:
+                server_stats.error(action)
+                kind, payload = ERROR, f'{type(e).__name__}: {e}'.encode()
+            if payload is None:
+                if _hung_up(conn):
+                    return
+                continue
+            with send_lock:
+                send_frame(conn, kind, rid, action, payload)
+            if kind != PUSH:
+                return
+    except OSError:
+        pass
+    finally:
+        values.close()
+
+def _respond(conn, send_lock, handle_request, rid, action, args, t_recv):
+    t0 = time.perf_counter()
+    kind, r = _handle(handle_request, action, args)
+    t1 = time.perf_counter()
+    if kind == REPLY and not isinstance(r, (bytes, bytearray, memoryview)):
+        _push(conn, send_lock, rid, action, r)
+        return
+    try:
+        with send_lock:
+            send_frame(conn, kind, rid, action, r)
+    except OSError:
+        pass
+    server_stats.record(action, 'queue', t0 - t_recv)
+    server_stats.record(action, 'call', t1 - t0)
+    server_stats.record(action, 'reply', time.perf_counter() - t1)
+
+def _serve_conn(conn, handle_request, resource_of, queues):
+    send_lock = threading.Lock()
+    pending = set()
+    with conn:
+        try:
+            while True:
+                _, rid, action, args = recv_frame(conn)
+                request = (conn, send_lock, handle_request, rid, action, args,
+                           time.perf_counter())
+                resource = (None if action == 'STATS'
+                            else resource_of(action, args))
+                if resource is None:
+                    _respond(*request)
+                else:
+                    pending = {f for f in pending if not f.done()}
+                    pending.add(queues(resource).submit(_respond, *request))
+        except ConnectionError:
+            pass
+        # the socket is only closed once the queued replies are sent, its
+        # file descriptor could otherwise be reused by the next connection
+        futures.wait(pending)
+
+def listen(port=0):
+    """ Listen on port of all interfaces and on the unix socket of the port.
+
+    Args:
+        port: (int) tcp port, 0 picks a free one
+    Returns:
+        (list) listening sockets, the tcp socket first
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('0.0.0.0', port))
+    s.listen()
+    socks = [s]
+    if hasattr(socket, 'AF_UNIX'):
+        path = unix_path(s.getsockname()[1])
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        u = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        u.bind(path)
+        u.listen()
+        socks.append(u)
+    return socks
+
+def inherit(arg):
+    """ Listening sockets of a server started by the supervisor.
+
+    Where sockets can be inherited, see PASS_FDS, the supervisor binds them
+    and passes their file descriptors. Elsewhere it passes 'port=n', and the
+    server listens on port n, any if 0, and reports the port on stdout in a
+    line starting with READY, which the supervisor waits for.
+
+    Args:
+        arg: (str) comma separated file descriptors of the sockets, or
+            'port=n', as given on the command line of the server
+    Returns:
+        (list) listening sockets, the tcp socket first
+    """
+    if arg.startswith('port='):
+        socks = listen(int(arg[len('port='):]))
+        print(f'{READY} {socks[0].getsockname()[1]}', flush=True)
+        return socks
+    return [socket.socket(fileno=int(fd)) for fd in arg.split(',')]
+
+async def start_servers(client_connected_cb, port=0, socks=None):
+    """ asyncio counterpart of listen().
+
+    The servers listen on socks, as returned by listen() or inherit(), if
+    given and else on port.
+
+    Returns:
+        (list) started asyncio servers, the tcp server first
+    """
+    if socks is not None:
+        server = await asyncio.start_server(client_connected_cb,
+                                            sock=socks[0])
+        servers = [server]
+        for s in socks[1:]:
+            servers.append(
+                await asyncio.start_unix_server(client_connected_cb, sock=s))
+        return servers
+    server = await asyncio.start_server(client_connected_cb, '0.0.0.0', port)
+    servers = [server]
+    if hasattr(socket, 'AF_UNIX'):
+        path = unix_path(server.sockets[0].getsockname()[1])
+        servers.append(
+            await asyncio.start_unix_server(client_connected_cb, path))
+    return servers
+
+def _accept(s, handle_request, resource_of, queues):
+    while True:
+        conn, addr = s.accept()
+        if conn.family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=_serve_conn,
+                         args=(conn, handle_request, resource_of, queues),
+                         daemon=True).start()
+
+def serve(socks, handle_request, resource_of=lambda action, args: ''):
+    """ Accept connections on the listening sockets socks forever.
+
+    socks is a listening socket or a list of them as returned by listen().
+    handle_request is called with the action and payload of each request
+    received and returns the reply payload, which may be None for an empty
+    reply. An exception raised by handle_request is sent back as an error
+    frame. Each connection is read on its own thread until the client closes
+    it.
+
+    resource_of maps an action and its payload to the resource it uses,
+    typically the name of the global holding the hardware handle. Requests
+    for one resource are handled one at a time in the order they arrive, each
+    resource on its own worker thread, so a slow read on one resource does
+    not hold up the others. A resource may also be an executor of its own,
+    which then runs its requests. Actions mapped to None touch no shared state
+    and are answered straight away on the connection thread. By default all
+    actions share one resource.
+    """
+    if isinstance(socks, socket.socket):
+        socks = [socks]
+    executors = {}
+    executors_lock = threading.Lock()
+
+    def queues(resource):
+        if isinstance(resource, futures.Executor):
+            return resource
+        with executors_lock:
+            if resource not in executors:
+                executors[resource] = futures.ThreadPoolExecutor(
+                    1, thread_name_prefix=f'serve-{resource}')
+            return executors[resource]
+
+    args = (handle_request, resource_of, queues)
+    for s in socks[1:]:
+        threading.Thread(target=_accept, args=(s, *args), daemon=True).start()
+    _accept(socks[0], *args)
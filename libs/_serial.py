@@ -1,15 +1,23 @@
-import socket
-
-def _comm(data, host=('localhost', 4292), timeout=10):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect(host)
-    s.settimeout(timeout)
-    s.send(data)
-    r = s.recv(1024)
-    return r 
-
-class SerialProxy(object):
-    """ module proxy """
+import collections
+import contextlib
+import itertools
+import threading
+import time
+import uuid
+from concurrent import futures
+
+from srd.libs import _registry
+from srd.libs._rpc import (AsyncProxy, Dispatcher, Proxy, inherit, listen,
+                           serve)
+
+class SerialProxy(Proxy):
+    """ module proxy
+
+    All proxies of a supervisor share one serial server, started with ENSURE,
+    which handles each open port on a thread of its own. In a cluster,
+    Serial() ensures the instance 'libs _serial.py <port>', so the port is
+    opened on the node it is attached to.
+    """
     EIGHTBITS = 8
     PARITY_NONE = 'N'
     STOPBITS_ONE = 1
@@ -17,20 +25,21 @@ class SerialProxy(object):
 
     def __init__(self, inithost=('localhost', 4292)):
         self._inithost = inithost
-        r = _comm('START libs _serial.py'.encode(), inithost)
-        self._libhost = inithost[0], int(r.decode())
-    
-    def __del__(self):
-        r = _comm(f'STOP {self._libhost[1]}'.encode(), self._inithost)
+        self._host = _registry.resolve('libs _serial.py', inithost)
     
     def _echo(self, message):
-        r = _comm(f'_echo {message}'.encode(), self._libhost)
-        return r.decode()
+        return self._call('_echo', message)
+
+    def _port_host(self, port):
+        # in a cluster, the port may be attached to another node
+        if port is None:
+            return self._host
+        return _registry.resolve(f'libs _serial.py {port}', self._inithost)
 
     def Serial(self, port=None, baudrate=9600, bytesize=EIGHTBITS, 
                parity=PARITY_NONE, stopbits=STOPBITS_ONE, 
                timeout=None, xonxoff=False, rtscts=False, write_timeout=None, 
-               dsrdtr=False, inter_byte_timeout=None):
+               dsrdtr=False, inter_byte_timeout=None, buffer_size=None):
         """ The port is immediately opened on object creation, 
         when a port is given. It is not opened when port is None and 
         a successive call to open() is required.
@@ -69,17 +78,25 @@ class SerialProxy(object):
         effect that its state follows rtscts. Also consider using the 
         function serial_for_url() instead of creating Serial instances 
         directly.
+
+        With buffer_size set, the server drains the port continuously into a
+        ring buffer of that many bytes on a background thread, and read() and
+        read_until() are served from it. When the buffer is full the oldest
+        bytes are dropped, see buffer_stats().
         """
-        return SerialSerialProxy(self._libhost, port, baudrate, bytesize, parity, 
-                               stopbits, timeout, xonxoff, rtscts, 
-                               write_timeout, dsrdtr, inter_byte_timeout)
+        return SerialSerialProxy(self._port_host(port), port, baudrate, 
+                               bytesize, parity, stopbits, timeout, xonxoff, 
+                               rtscts, write_timeout, dsrdtr, 
+                               inter_byte_timeout, buffer_size)
+
+class SerialSerialProxy(Proxy):
+    _prefix = 'Serial.'
 
-class SerialSerialProxy(object):
     def __init__(self, host, port=None, baudrate=9600, 
                  bytesize=SerialProxy.EIGHTBITS, parity=SerialProxy.PARITY_NONE, 
                  stopbits=SerialProxy.STOPBITS_ONE, timeout=None, xonxoff=False, 
                  rtscts=False, write_timeout=None, dsrdtr=False, 
-                 inter_byte_timeout=None):
+                 inter_byte_timeout=None, buffer_size=None):
         """ The port is immediately opened on object creation, 
         when a port is given. It is not opened when port is None and 
         a successive call to open() is required.
@@ -118,6 +135,11 @@ class SerialSerialProxy(object):
         effect that its state follows rtscts. Also consider using the 
         function serial_for_url() instead of creating Serial instances 
         directly.
+
+        With buffer_size set, the server drains the port continuously into a
+        ring buffer of that many bytes on a background thread, and read() and
+        read_until() are served from it. When the buffer is full the oldest
+        bytes are dropped, see buffer_stats().
         """
         self._host = host
 
@@ -126,68 +148,102 @@ class SerialSerialProxy(object):
                   'stopbits': stopbits, 'timeout': timeout,
                   'xonxoff': xonxoff, 'rtscts': rtscts, 
                   'write_timeout': write_timeout, 'dsrdtr': dsrdtr,
-                  'inter_byte_timeout': inter_byte_timeout}
-        
-        r = _comm(f'Serial {kwargs}'.encode(), self._host)
+                  'inter_byte_timeout': inter_byte_timeout,
+                  'buffer_size': buffer_size}
+        self._open(kwargs)
+
+    def _open(self, kwargs):
+        self._handle = self._call('Serial', kwargs)
+        self.get_settings()
     
     def __del__(self):
-        self.close()
+        if getattr(self, '_handle', None) is not None:
+            self.close()
+
+    def get_settings(self):
+        """ Read the settings of the port from the server.
+
+        The properties and get() answer from a copy of the settings, taken
+        when the port is opened and updated by every setter, without a round
+        trip. This refreshes it, should the port have been changed otherwise.
+
+        Returns:
+            (dict) baudrate, bytesize, parity, stopbits, xonxoff, dsrdtr,
+                rtscts, timeout, write_timeout and inter_byte_timeout
+        """
+        self._settings = self._call('Serial.get_settings', self._handle)
+        return dict(self._settings)
+
+    def _setting(self, name):
+        return self._settings[name]
+
+    def _set(self, name, value):
+        r = self._call(f'Serial.{name}_setattr', self._handle, value)
+        self._settings[name] = value
+        return r
+
+    def get(self, *names):
+        """ Read one or more settings, see get_settings().
+
+        Returns:
+            the value of the setting if a single name is given, otherwise a
+            list of values in the order of names
+        """
+        values = [self._settings[name] for name in names]
+        return values[0] if len(names) == 1 else values
 
     @property
     def baudrate(self):
         """ Read or write current baud rate setting.
         Type: int
         """
-        r = _comm(f'Serial.baudrate_getattr'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._setting('baudrate')
 
     @baudrate.setter
     def baudrate(self, baudrate):
         """ Read or write current baud rate setting.
         Type: int
         """
-        r = _comm(f'Serial.baudrate_setattr {baudrate}'.encode(), self._host)
+        return self._set('baudrate', baudrate)
 
     @property
     def bytesize(self):
         """ Read or write current byte size setting.
         Type: int
         """
-        r = _comm(f'Serial.bytesize_getattr'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._setting('bytesize')
 
     @bytesize.setter
     def bytesize(self, bytesize):
         """ Read or write current byte size setting.
         Type: int
         """
-        r = _comm(f'Serial.bytesize_setattr {bytesize}'.encode(), self._host)
+        return self._set('bytesize', bytesize)
 
     def close(self):
         """ Close port """
-        r = _comm(f'Serial.close'.encode(), self._host)
+        handle, self._handle = self._handle, None
+        return self._call('Serial.close', handle)
         
     @property
     def dsrdtr(self):
         """ Read or write current hardware flow control setting.
         Type: bool
         """
-        r = _comm(f'Serial.dsrdtr_getattr'.encode(), self._host)
-        return bool(r)
+        return self._setting('dsrdtr')
 
     @dsrdtr.setter
     def dsrdtr(self, dsrdtr):
         """ Read or write current hardware flow control setting.
         Type: bool
         """
-        r = _comm(f'Serial.dsrdtr_setattr {dsrdtr}'.encode(), self._host)
+        return self._set('dsrdtr', dsrdtr)
 
     @property
     def parity(self):
         """ Get current parity setting 
         """
-        r = _comm(f'Serial.parity_getattr'.encode(), self._host)
-        return r.decode()
+        return self._setting('parity')
 
     @parity.setter
     def parity(self, parity):
@@ -195,50 +251,47 @@ class SerialSerialProxy(object):
         Possible values: PARITY_NONE, PARITY_EVEN, PARITY_ODD,
                          PARITY_MARK, PARITY_SPACE
         """
-        r = _comm(f'Serial.parity_setattr {parity}'.encode(), self._host)
+        return self._set('parity', parity)
     
     @property
     def rtscts(self):
         """ Get current hardware flow control setting
         Type: bool
         """
-        r = _comm(f'Serial.rtscts_getattr'.encode(), self._host)
-        return bool(r)
+        return self._setting('rtscts')
 
     @rtscts.setter
     def rtscts(self, rtscts):
         """ Enable or disable hardware flow control setting
         Type: bool
         """
-        r = _comm(f'Serial.rtscts_setattr {rtscts}'.encode(), self._host)
+        return self._set('rtscts', rtscts)
 
     @property
     def stopbits(self):
         """ Get current stop bit setting """
-        r = _comm(f'Serial.stopbits_getattr'.encode(), self._host)
-        return int.from_bytes(r, 'big')
+        return self._setting('stopbits')
 
     @stopbits.setter
     def stopbits(self, stopbits):
         """ Set new stop bit settings
         Possible values: STOPBITS_ONE, STOPBITS_ONE_POINT_FIVE, STOPBITS_TWO
         """
-        r = _comm(f'Serial.stopbits_setattr {stopbits}'.encode(), self._host)
+        return self._set('stopbits', stopbits)
 
     @property
     def timeout(self):
         """ Get current read timeout setting
         Type: float (seconds)
         """
-        r = _comm(f'Serial.timeout_getattr'.encode(), self._host)
-        return struct.unpack('>f', r)[0]
+        return self._setting('timeout')
 
     @timeout.setter
     def timeout(self, timeout):
         """ Set read timeout 
         Type: float (seconds)
         """
-        r = _comm(f'Serial.timeout_setattr {timeout}'.encode(), self._host)
+        return self._set('timeout', timeout)
 
     def read(self, size=1):
         """ Read size bytes from the serial port. If a timeout is 
@@ -251,8 +304,7 @@ class SerialSerialProxy(object):
         Returns:
             (bytes) Bytes read from the port.
         """
-        r = _comm(f'Serial.read {size}'.encode(), self._host)
-        return r
+        return self._call('Serial.read', self._handle, size)
 
     def read_until(self, expected=SerialProxy.LF, size=None):
         """ Read size bytes from the serial port. If a timeout is set 
@@ -265,8 +317,7 @@ class SerialSerialProxy(object):
         Returns:	
             (bytes) Bytes read from the port.
         """
-        r = _comm(f'Serial.read_until {expected.decode()} {size}'.encode(), self._host)
-        return r
+        return self._call('Serial.read_until', self._handle, expected, size)
 
     def write(self, data):
         """ Write the bytes data to the port. 
@@ -284,115 +335,573 @@ class SerialSerialProxy(object):
                 In case a write timeout is configured for the port and 
                 the time is exceeded.
         """
-        r = _comm(f'Serial.write {data.decode()}'.encode(), self._host)
-        return int.from_bytes(r, 'big')
-
-def handle_request(conn):
-    global ser
-    data = conn.recv(1024)
-    action, _, args = data.partition(b" ")
-
-    if action == b'_echo':
-        conn.send(args)
-    elif action == b'Serial':
-        kwargs = eval(args)
-        ser = serial.Serial(**kwargs)
-        conn.send(b'')
-    elif action == b'Serial.baudrate_getattr':
-        baudrate = ser.baudrate
-        conn.send(int(baudrate).to_bytes(4, 'big'))
-    elif action == b'Serial.baudrate_setattr':
-        baudrate = int(args)
-        ser.baudrate = baudrate
-        conn.send(b'')
-    elif action == b'Serial.bytesize_getattr':
-        bytesize = ser.bytesize
-        conn.send(int(bytesize).to_bytes(4, 'big'))
-    elif action == b'Serial.bytesize_setattr':
-        bytesize = int(args)
-        ser.bytesize = bytesize
-        conn.send(b'')
-    elif action == b'Serial.close':
+        return self._call('Serial.write', self._handle, data)
+
+    def query(self, data, expected=SerialProxy.LF, size=None, delay=0):
+        """ Write data and read the reply as read_until() does, in a single
+        round trip. No other request for the port is handled in between. In
+        the buffered mode, input that arrived before data is dropped.
+
+        Parameters:
+            data (bytes): Data to send.
+            expected (bytes): The byte string ending the reply.
+            size (int): Number of bytes to read at most.
+            delay (float): Seconds to wait between writing and reading.
+        Returns:
+            (bytes) Bytes read from the port.
+        """
+        return self._call('Serial.query', self._handle, data, expected, size,
+                          delay)
+
+    def query_batch(self, queries):
+        """ Run several queries one after another in a single round trip.
+
+        Parameters:
+            queries (list): data (bytes) of each query, or a tuple of the
+                arguments of query(), (data, expected, size, delay), of which
+                the trailing ones may be left out.
+        Returns:
+            (list) Reply of each query.
+        """
+        queries = [(q,) if isinstance(q, (bytes, bytearray)) else tuple(q)
+                   for q in queries]
+        return self._call('Serial.query_batch', self._handle, queries)
+
+    def buffer_stats(self):
+        """ Counters of the ring buffer of a port opened with buffer_size.
+
+        Returns:
+            (dict) 'size' bytes the buffer holds, 'occupancy' bytes in it now,
+                'high_water' most bytes it has held, 'received' bytes read
+                from the port, 'overruns' times bytes were dropped because it
+                was full, 'dropped' bytes dropped, and 'subscribers', the
+                'queued' and 'dropped' chunks of each subscriber, or None
+                without buffer
+        """
+        return self._call('Serial.buffer_stats', self._handle)
+
+    def subscribe(self, delimiter=SerialProxy.LF, limit=1 << 20):
+        """ Receive everything the port receives from now on, pushed by
+        the server over a connection of its own.
+
+        The port is switched to the buffered mode of buffer_size if it is not
+        in it yet. read(), read_until() and query() keep working alongside,
+        but while there are subscribers they only see what arrives while they
+        wait, not what was pushed to the subscribers before. Each subscriber
+        has its own queue of at most limit bytes. When a subscriber falls
+        behind by more than that, its oldest chunks are dropped, without
+        holding up the port or the other subscribers.
+
+        Parameters:
+            delimiter (bytes): split the data into lines ending with
+                delimiter, or None for the chunks as they are read
+            limit (int): bytes queued for this subscriber at most
+        Returns:
+            generator of the lines or chunks (bytes), close it to unsubscribe
+        """
+        sid = self._call('Serial.subscribe', self._handle, delimiter, limit)
+        return self._chunks(self._stream('Serial.stream', self._handle, sid))
+
+    @staticmethod
+    def _chunks(batches):
+        for batch in batches:
+            yield from batch
+
+class AsyncSerialProxy(AsyncProxy, SerialProxy):
+    """ asyncio counterpart of SerialProxy.
+
+    Start it with `serial = await AsyncSerialProxy.start(inithost)`. Serial()
+    is a coroutine returning an AsyncSerialSerialProxy.
+    """
+    def __init__(self, inithost, host):
+        self._inithost = inithost
+        self._host = host
+
+    @classmethod
+    async def start(cls, inithost=('localhost', 4292)):
+        return cls(inithost,
+                   await _registry.aresolve('libs _serial.py', inithost))
+
+    async def _port_host(self, port):
+        if port is None:
+            return self._host
+        return await _registry.aresolve(f'libs _serial.py {port}',
+                                        self._inithost)
+
+    async def Serial(self, *args, **kwargs):
+        port = args[0] if args else kwargs.get('port')
+        ser = AsyncSerialSerialProxy(await self._port_host(port), *args,
+                                     **kwargs)
+        await ser._opening
+        return ser
+
+class AsyncSerialSerialProxy(AsyncProxy, SerialSerialProxy):
+    """ asyncio counterpart of SerialSerialProxy.
+
+    The port is not closed when the proxy is garbage collected, call
+    `await ser.close()` when done with it.
+    """
+    def _open(self, kwargs):
+        self._opening = self._aopen(kwargs)
+
+    async def _aopen(self, kwargs):
+        self._handle = await self._call('Serial', kwargs)
+        await self.get_settings()
+
+    async def get_settings(self):
+        self._settings = await self._call('Serial.get_settings',
+                                          self._handle)
+        return dict(self._settings)
+
+    async def _setting(self, name):
+        return self._settings[name]
+
+    async def _set(self, name, value):
+        r = await self._call(f'Serial.{name}_setattr', self._handle, value)
+        self._settings[name] = value
+        return r
+
+    async def get(self, *names):
+        return SerialSerialProxy.get(self, *names)
+
+    def __del__(self):
+        pass
+
+    async def subscribe(self, delimiter=SerialProxy.LF, limit=1 << 20):
+        """ Counterpart of SerialSerialProxy.subscribe() returning an async
+        iterator, `async for line in await ser.subscribe()`.
+        """
+        sid = await self._call('Serial.subscribe', self._handle, delimiter,
+                               limit)
+        return self._chunks(self._stream('Serial.stream', self._handle, sid))
+
+    @staticmethod
+    async def _chunks(batches):
+        async for batch in batches:
+            for chunk in batch:
+                yield chunk
+
+class RingBuffer(object):
+    """ Fixed size byte queue that drops its oldest bytes when full. """
+    def __init__(self, size):
+        self._buf = bytearray(size)
+        self._size = size
+        self._start = 0
+        self._count = 0
+        self.high_water = 0
+        self.received = 0
+        self.overruns = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, data):
+        self.received += len(data)
+        excess = self._count + len(data) - self._size
+        if excess > 0:
+            self.overruns += 1
+            self.dropped += excess
+            if len(data) > self._size:
+                data = data[len(data) - self._size:]
+                self._start = self._count = 0
+            else:
+                self._start = (self._start + excess) % self._size
+                self._count -= excess
+        n = len(data)
+        end = (self._start + self._count) % self._size
+        first = min(n, self._size - end)
+        self._buf[end:end + first] = data[:first]
+        self._buf[:n - first] = data[first:]
+        self._count += n
+        self.high_water = max(self.high_water, self._count)
+
+    def peek(self):
+        """ All bytes in the buffer, without removing them. """
+        end = self._start + self._count
+        if end <= self._size:
+            return bytes(self._buf[self._start:end])
+        return bytes(self._buf[self._start:] + self._buf[:end - self._size])
+
+    def get(self, size):
+        """ Remove and return up to size bytes. """
+        size = min(size, self._count)
+        end = self._start + size
+        if end <= self._size:
+            data = bytes(self._buf[self._start:end])
+        else:
+            data = bytes(self._buf[self._start:]
+                         + self._buf[:end - self._size])
+        self._start = end % self._size
+        self._count -= size
+        return data
+
+    def stats(self):
+        return {'size': self._size, 'occupancy': self._count,
+                'high_water': self.high_water, 'received': self.received,
+                'overruns': self.overruns, 'dropped': self.dropped}
+
+class Subscriber(object):
+    """ Queue of the data of a port for one streaming client.
+
+    The reader thread feeds it and never waits for it: once more than limit
+    bytes are queued the oldest chunks are dropped.
+    """
+    def __init__(self, delimiter, limit):
+        self.delimiter = delimiter
+        self.limit = limit
+        self.dropped = 0
+        self.closed = False
+        self._chunks = collections.deque()
+        self._size = 0
+        self._partial = b''
+        self._cond = threading.Condition()
+
+    def feed(self, data):
+        if self.delimiter:
+            *lines, self._partial = (self._partial + data).split(
+                    self.delimiter)
+            chunks = [line + self.delimiter for line in lines]
+            if len(self._partial) >= self.limit:
+                chunks.append(self._partial)
+                self._partial = b''
+        else:
+            chunks = [data]
+        with self._cond:
+            for chunk in chunks:
+                self._chunks.append(chunk)
+                self._size += len(chunk)
+            # the newest chunk is kept even when it alone is over limit
+            while self._size > self.limit and len(self._chunks) > 1:
+                self._size -= len(self._chunks.popleft())
+                self.dropped += 1
+            if chunks:
+                self._cond.notify()
+
+    def take(self, timeout):
+        """ Remove and return the queued chunks, waiting up to timeout for
+        the first.
+        """
+        with self._cond:
+            if not self._chunks and not self.closed:
+                self._cond.wait(timeout)
+            chunks = list(self._chunks)
+            self._chunks.clear()
+            self._size = 0
+            return chunks
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def stats(self):
+        return {'queued': len(self._chunks), 'dropped': self.dropped}
+
+class BufferedReader(object):
+    """ Drains a port into a RingBuffer from a background thread and serves
+    read() and read_until() from it, with the timeout semantics of the port.
+
+    The port itself is read with a short timeout so the thread notices
+    close(); the timeout set by the client is kept here instead. While there
+    are subscribers, the buffer only keeps what arrives during reading(), so
+    reads do not return data the subscribers were pushed long before.
+    """
+    POLL = 0.05
+
+    def __init__(self, ser, size):
+        self.ser = ser
+        self.timeout = ser.timeout
+        self.buffer = RingBuffer(size)
+        self.error = None
+        self.subscribers = {}
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._reading = 0
+        ser.timeout = self.POLL
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while not self._closed:
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except Exception as e:
+                with self._cond:
+                    if not self._closed:
+                        self.error = e
+                    self._cond.notify_all()
+                self._close_subscribers()
+                return
+            if data:
+                with self._cond:
+                    if not self.subscribers or self._reading:
+                        self.buffer.put(data)
+                        self._cond.notify_all()
+                for subscriber in list(self.subscribers.values()):
+                    subscriber.feed(data)
+
+    @contextlib.contextmanager
+    def reading(self):
+        """ Keep what the port receives meanwhile for the reads made within,
+        also while there are subscribers.
+        """
+        with self._cond:
+            self._reading += 1
         try:
-            ser.close()
+            yield
+        finally:
+            with self._cond:
+                self._reading -= 1
+
+    def discard(self):
+        """ Drop the buffered input. """
+        with self._cond:
+            self.buffer.get(len(self.buffer))
+
+    def _wait(self, done):
+        """ Wait until done() or the read timeout, return the buffer. """
+        deadline = None if self.timeout is None else (
+                time.monotonic() + self.timeout)
+        with self._cond:
+            while not done() and self.error is None and not self._closed:
+                remaining = None if deadline is None else (
+                        deadline - time.monotonic())
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self.error is not None and not len(self.buffer):
+                raise self.error
+            return self.buffer
+
+    def read(self, size=1):
+        with self.reading():
+            buffer = self._wait(lambda: len(self.buffer) >= size)
+            with self._cond:
+                return buffer.get(size)
+
+    def read_until(self, expected=b'\n', size=None):
+        searched = 0
+        found = -1
+
+        def done():
+            nonlocal searched, found
+            data = self.buffer.peek()
+            found = data.find(expected, max(searched - len(expected) + 1, 0))
+            searched = len(data)
+            return found >= 0 or (size is not None and len(data) >= size)
+
+        with self.reading():
+            buffer = self._wait(done)
+            with self._cond:
+                n = len(buffer) if found < 0 else found + len(expected)
+                return buffer.get(n if size is None else min(n, size))
+
+    def subscribe(self, delimiter, limit):
+        """ Add a Subscriber and return its id. """
+        sid = next(self._ids)
+        self.subscribers[sid] = Subscriber(delimiter, limit)
+        return sid
+
+    def _close_subscribers(self):
+        for subscriber in list(self.subscribers.values()):
+            subscriber.close()
+
+    def stats(self):
+        with self._cond:
+            stats = self.buffer.stats()
+        stats['subscribers'] = [subscriber.stats() for subscriber
+                                in list(self.subscribers.values())]
+        return stats
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._close_subscribers()
+
+class Port(object):
+    """ An open port and the thread its requests are handled on, one at a
+    time and in the order they arrive.
+    """
+    def __init__(self, handle, kwargs):
+        size = kwargs.pop('buffer_size', None)
+        self.ser = serial.Serial(**kwargs)
+        self.reader = BufferedReader(self.ser, size) if size else None
+        # its thread ends once the port is closed and the executor dropped
+        self.executor = futures.ThreadPoolExecutor(
+                1, thread_name_prefix=f'serial-{handle}')
+
+    def close(self):
+        try:
+            if self.reader is not None:
+                self.reader.close()
+            self.ser.close()
         except:
             pass
-        conn.send(b'')
-    elif action == b'Serial.dsrdtr_getattr':
-        dsrdtr = ser.dsrdtr
-        conn.send(int(dsrdtr).to_bytes(1, 'big'))
-    elif action == b'Serial.dsrdtr_setattr':
-        dsrdtr = int(args)
-        ser.dsrdtr = dsrdtr
-        conn.send(b'')
-    elif action == b'Serial.parity_getattr':
-        parity = ser.parity
-        conn.send(parity.encode())
-    elif action == b'Serial.parity_setattr':
-        parity = args.decode()
-        ser.parity = parity
-        conn.send(b'')
-    elif action == b'Serial.rtscts_getattr':
-        rtscts = ser.rtscts
-        conn.send(int(rtscts).to_bytes(1, 'big'))
-    elif action == b'Serial.rtscts_setattr':
-        rtscts = int(args)
-        ser.rtscts = rtscts
-        conn.send(b'')
-    elif action == b'Serial.stopbits_getattr':
-        stopbits = ser.stopbits
-        conn.send(int(stopbits).to_bytes(4, 'big'))
-    elif action == b'Serial.stopbits_setattr':
-        stopbits = int(args)
-        ser.stopbits = stopbits
-        conn.send(b'')
-    elif action == b'Serial.timeout_getattr':
-        timeout = ser.timeout
-        try:
-            conn.send(struct.pack('>f', float(timeout)))
-        except TypeError:
-            conn.send(b'')
-    elif action == b'Serial.timeout_setattr':
-        timeout = float(args)
-        ser.timeout = timeout
-        conn.send(b'')
-    elif action == b'Serial.read':
-        size = args.decode()
-        size = None if size == 'None' else int(size)
-        bytes_ = ser.read(size)
-        conn.send(bytes_)
-    elif action == b'Serial.read_until':
-        expected, size = args.decode().split(' ')
-        size = None if size == 'None' else int(size)
-        bytes_ = ser.read_until(expected.encode(), size)
-        conn.send(bytes_)
-    elif action == b'Serial.write':
-        data = args.decode()
-        numbytes = ser.write(data.encode())
-        conn.send(int(numbytes).to_bytes(4, 'big'))
 
+    # the port of a BufferedReader is polled, the client's timeout is its own
+    def getattr(self, name):
+        if name == 'timeout' and self.reader is not None:
+            return self.reader.timeout
+        return getattr(self.ser, name)
+
+    def setattr(self, name, value):
+        if name == 'timeout' and self.reader is not None:
+            self.reader.timeout = value
+        else:
+            setattr(self.ser, name, value)
+
+    def settings(self):
+        settings = self.ser.get_settings()
+        if self.reader is not None:
+            settings['timeout'] = self.reader.timeout
+        return settings
+
+    def read(self, size=1):
+        if self.reader is not None:
+            return self.reader.read(size)
+        return self.ser.read(size)
+
+    def read_until(self, expected, size):
+        if self.reader is not None:
+            return self.reader.read_until(expected, size)
+        return self.ser.read_until(expected, size)
+
+    def query(self, data, expected=b'\n', size=None, delay=0):
+        if self.reader is None:
+            self.ser.write(data)
+            if delay:
+                time.sleep(delay)
+            return self.ser.read_until(expected, size)
+        # the reply is what arrives after data was written
+        with self.reader.reading():
+            self.reader.discard()
+            self.ser.write(data)
+            if delay:
+                time.sleep(delay)
+            return self.reader.read_until(expected, size)
+
+    def subscribe(self, delimiter, limit):
+        if self.reader is None:
+            self.reader = BufferedReader(self.ser, SUBSCRIBE_BUFFER)
+        return self.reader.subscribe(delimiter, limit)
+
+# buffer of a port switched to the buffered mode by a subscriber
+SUBSCRIBE_BUFFER = 1 << 16
+# seconds a stream waits for data before it checks on its client
+STREAM_IDLE = 1
+
+ports = {}
+# handles start with a prefix of their own in every server process, so that
+# a handle kept from a server that has since restarted is not open, instead of
+# naming whichever port the new server opened under the same number
+_boot = uuid.uuid4().hex[:12]
+_handles = (f'{_boot}-{n}' for n in itertools.count())
+
+def _port(handle):
+    try:
+        return ports[handle]
+    except KeyError:
+        raise ValueError(f'port {handle} is not open') from None
+
+def _executor(handle):
+    """ Resource of the requests for the port handle. """
+    port = ports.get(handle)
+    return None if port is None else port.executor
+
+server = Dispatcher()
+
+@server.register('_echo', resource=None)
+def _echo(message):
+    return message
+
+@server.register('Serial', 'open')
+def _open(kwargs):
+    handle = next(_handles)
+    ports[handle] = Port(handle, kwargs)
+    return handle
+
+@server.register('Serial.close', _executor)
+def _close(handle):
+    port = ports.pop(handle, None)
+    if port is not None:
+        port.close()
+
+def _register_attribute(name):
+    def getattr_(handle):
+        return _port(handle).getattr(name)
+
+    def setattr_(handle, value):
+        _port(handle).setattr(name, value)
+
+    server.register(f'Serial.{name}_getattr', _executor)(getattr_)
+    server.register(f'Serial.{name}_setattr', _executor)(setattr_)
+
+for name in ('baudrate', 'bytesize', 'dsrdtr', 'parity', 'rtscts', 'stopbits',
+             'timeout'):
+    _register_attribute(name)
+
+@server.register('Serial.get_settings', _executor)
+def _get_settings(handle):
+    return _port(handle).settings()
+
+@server.register('Serial.read', _executor)
+def _read(handle, size=1):
+    return _port(handle).read(size)
+
+@server.register('Serial.read_until', _executor)
+def _read_until(handle, expected, size):
+    return _port(handle).read_until(expected, size)
+
+@server.register('Serial.write', _executor)
+def _write(handle, data):
+    return _port(handle).ser.write(data)
+
+@server.register('Serial.subscribe', _executor)
+def _subscribe(handle, delimiter, limit):
+    return _port(handle).subscribe(delimiter, limit)
+
+@server.stream('Serial.stream')
+def _stream(handle, sid):
+    subscribers = _port(handle).reader.subscribers
+    subscriber = subscribers[sid]
+    try:
+        while True:
+            chunks = subscriber.take(STREAM_IDLE)
+            if chunks:
+                yield chunks
+            elif subscriber.closed:
+                return
+            else:
+                yield None
+    finally:
+        subscribers.pop(sid, None)
+
+@server.register('Serial.query', _executor)
+def _query(handle, data, expected=b'\n', size=None, delay=0):
+    return _port(handle).query(data, expected, size, delay)
+
+@server.register('Serial.query_batch', _executor)
+def _query_batch(handle, queries):
+    port = _port(handle)
+    return [port.query(*query) for query in queries]
+
+@server.register('Serial.buffer_stats', _executor)
+def _buffer_stats(handle):
+    reader = _port(handle).reader
+    if reader is not None:
+        return reader.stats()
 
 if __name__ == "__main__":
     import serial 
     import sys
 
-    ser = None
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
     if len(sys.argv) == 2:
-        s.bind(("0.0.0.0", 0))
-        pid = sys.argv[1]
-        port = s.getsockname()[1]
-        stmp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        stmp.connect(("localhost", 42922))
-        stmp.send(f"PORT {pid} {port}".encode())
-        s.listen(1)
+        socks = inherit(sys.argv[1])
     else:
-        s.bind(("0.0.0.0", 65050))
-        s.listen(1)
+        socks = listen(65050)
 
-    while True:
-        conn, addr = s.accept()
-        handle_request(conn)
-        conn.close()
+    serve(socks, server, server.resource_of)
@@ -0,0 +1,87 @@
+""" Per-action call counters and latency histograms.
+
+The client records for each action the time to connect, to send the request
+and to get the reply back. Servers record the time a request waits for its
+resource, the time spent in the handler, which is the hardware call, and the
+time to send the reply. A server reports its numbers for the STATS action.
+"""
+import math
+import threading
+
+# quarter octave buckets from 1 us, about 19 % wide
+_BUCKETS_PER_OCTAVE = 4
+_NUM_BUCKETS = 128
+
+class Histogram(object):
+    """ Log-bucketed histogram of durations in seconds. """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = [0] * _NUM_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        us = seconds * 1e6
+        i = int(math.log2(us) * _BUCKETS_PER_OCTAVE) + 1 if us >= 1 else 0
+        self._buckets[min(i, _NUM_BUCKETS - 1)] += 1
+
+    def quantile(self, q):
+        """ Upper edge of the bucket holding quantile q, in seconds. """
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self._buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(2 ** (i / _BUCKETS_PER_OCTAVE) * 1e-6, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'max': self.max}
+
+class Stats(object):
+    """ Histograms of the stages of each action, safe to share between
+    threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._errors = {}
+
+    def record(self, action, stage, seconds):
+        with self._lock:
+            stages = self._stages.setdefault(action, {})
+            if stage not in stages:
+                stages[stage] = Histogram()
+            stages[stage].add(seconds)
+
+    def error(self, action):
+        with self._lock:
+            self._errors[action] = self._errors.get(action, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._stages.clear()
+            self._errors.clear()
+
+    def snapshot(self):
+        """ Summary of every stage of every action.
+
+        Returns:
+            (dict) {action: {'errors': n, stage: {'count', 'mean', 'p50',
+            'p99', 'max'}}} with durations in seconds
+        """
+        with self._lock:
+            snapshot = {}
+            for action in self._stages.keys() | self._errors.keys():
+                stages = self._stages.get(action, {})
+                summary = {stage: h.summary() for stage, h in stages.items()}
+                summary['errors'] = self._errors.get(action, 0)
+                snapshot[action] = summary
+            return snapshot
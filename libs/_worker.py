@@ -0,0 +1,44 @@
+""" Interpreter kept warm by the supervisor to run a lib or device server.
+
+The worker imports the rpc layer and whichever of the hardware libraries are
+installed, then waits for one line on stdin naming the module to run and the
+argument to pass it:
+
+    /path/to/libs/_serial.py 3,4
+
+and runs that module as __main__, exactly as `python /path/to/libs/_serial.py
+3,4` would, only without paying for the interpreter start and the imports.
+The argument is that of _rpc.inherit(). The worker exits when stdin closes
+before a module was given.
+"""
+import importlib
+import os
+import runpy
+import sys
+import time
+
+import srd.libs._rpc
+import srd.devs._device
+
+PRELOAD = ('numpy', 'multiprocessing.shared_memory', 'serial', 'pyvisa',
+           'ok')
+
+def preload(names=PRELOAD):
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+def run(line):
+    path, _, arg = line.rstrip('\n').rpartition(' ')
+    sys.argv = [path, arg]
+    sys.path[0] = os.path.dirname(path)
+    srd.libs._rpc.started = time.perf_counter()
+    runpy.run_path(path, run_name='__main__')
+
+if __name__ == "__main__":
+    preload()
+    line = sys.stdin.readline()
+    if line.strip():
+        run(line)
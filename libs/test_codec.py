@@ -0,0 +1,99 @@
+""" Round trips of the values _codec encodes.
+
+    python -m pytest libs/test_codec.py
+"""
+import math
+import unittest
+
+from srd.libs._codec import pack, unpack, unpack_value
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class RoundTrip(unittest.TestCase):
+    def roundtrip(self, value):
+        r = unpack_value(pack(value))
+        self.assertEqual(r, value)
+        self.assertIs(type(r), type(value))
+        return r
+
+    def test_scalars(self):
+        for value in (None, True, False, 0, -1, 1 << 62, -(1 << 63),
+                      (1 << 63) - 1, 'setpoint', '', 'µ°', b'', b'\x00\xff'):
+            self.roundtrip(value)
+
+    def test_long_ints(self):
+        for value in (1 << 63, -(1 << 63) - 1, 1 << 64, -(1 << 64),
+                      3 ** 200, -(3 ** 200), (1 << 71) - 1, -(1 << 71)):
+            self.roundtrip(value)
+
+    def test_floats_are_lossless(self):
+        for value in (0.0, -0.0, 0.1, 1 / 3, 5e-324, 1.7976931348623157e308,
+                      math.inf, -math.inf):
+            self.roundtrip(value)
+        self.assertTrue(math.isnan(unpack_value(pack(math.nan))))
+        self.assertEqual(math.copysign(1, unpack_value(pack(-0.0))), -1)
+
+    def test_bytes_like(self):
+        self.assertEqual(unpack_value(pack(bytearray(b'ab'))), b'ab')
+        self.assertEqual(unpack_value(pack(memoryview(b'abcd')[1:3])), b'bc')
+
+    def test_containers(self):
+        self.roundtrip([1, 'a', [2.5, None], (b'x',)])
+        self.roundtrip((1, (2, (3, ()))))
+        self.roundtrip({'port': '/dev/ttyUSB0', 1: [True], (1, 2): {}})
+        self.roundtrip([])
+        self.roundtrip({})
+
+    def test_several_values(self):
+        values = [1, 'two', 3.0, None, [b'4']]
+        self.assertEqual(unpack(pack(*values)), values)
+        self.assertEqual(unpack(pack()), [])
+        self.assertIsNone(unpack_value(b''))
+
+    def test_subclasses_pack_as_their_base(self):
+        class Level(int):
+            pass
+        r = unpack_value(pack(Level(5)))
+        self.assertEqual(r, 5)
+        self.assertIs(type(r), int)
+
+    def test_unknown_types(self):
+        with self.assertRaises(TypeError):
+            pack(object())
+        with self.assertRaises(ValueError):
+            unpack(b'?')
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class Arrays(unittest.TestCase):
+    def test_dtypes_and_shapes(self):
+        for dtype in ('u1', '<i2', '>i4', '<u8', '<f4', '>f8', '<c16', '?'):
+            for shape in ((0,), (7,), (2, 3), (2, 1, 4)):
+                a = numpy.arange(math.prod(shape)).astype(dtype).reshape(shape)
+                r = unpack_value(pack(a))
+                self.assertEqual(r.dtype, a.dtype)
+                self.assertEqual(r.shape, a.shape)
+                numpy.testing.assert_array_equal(r, a)
+                # received arrays own writable memory
+                self.assertTrue(r.flags.writeable)
+
+    def test_non_contiguous(self):
+        a = numpy.arange(24, dtype='<f8').reshape(4, 6)[::2, 1::2]
+        numpy.testing.assert_array_equal(unpack_value(pack(a)), a)
+        numpy.testing.assert_array_equal(unpack_value(pack(a.T)), a.T)
+
+    def test_scalars_become_python_values(self):
+        for value in numpy.float64(0.1), numpy.int32(-3), numpy.bool_(True):
+            r = unpack_value(pack(value))
+            self.assertEqual(r, value.item())
+            self.assertIs(type(r), type(value.item()))
+
+    def test_in_containers(self):
+        a = numpy.ones((2, 2), '<f4')
+        r = unpack_value(pack({'trace': [a, 1]}))
+        numpy.testing.assert_array_equal(r['trace'][0], a)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+""" Framing, pipelining, errors and streams of _rpc, against a Dispatcher
+served on a thread of the test process.
+
+    python -m pytest libs/test_rpc.py
+"""
+import asyncio
+import threading
+import unittest
+
+from srd.libs import _rpc
+from srd.libs._codec import pack, unpack_value
+
+server = _rpc.Dispatcher()
+released = threading.Event()
+
+@server.register('echo', resource=None)
+def echo(value):
+    return value
+
+@server.register('wait', 'a')
+def wait():
+    # answered only once release, on another resource, has run
+    return released.wait(5)
+
+@server.register('release', 'b')
+def release():
+    released.set()
+    return True
+
+@server.register('fail')
+def fail(message):
+    raise ValueError(message)
+
+@server.stream('count')
+def count(n):
+    for i in range(n):
+        yield i
+
+def setUpModule():
+    global socks, host
+    socks = _rpc.listen(0)
+    host = ('localhost', socks[0].getsockname()[1])
+    threading.Thread(target=_rpc.serve, daemon=True,
+                     args=(socks, server, server.resource_of)).start()
+
+def tearDownModule():
+    _rpc.close(host)
+    _rpc.unlink(host[1])
+
+def call(action, *args):
+    return unpack_value(_rpc._comm(action, pack(*args), host))
+
+class Framing(unittest.TestCase):
+    def test_small_payload(self):
+        self.assertEqual(call('echo', b'x'), b'x')
+
+    def test_large_payloads(self):
+        for size in (1025, 1 << 16, 3 << 20):
+            data = bytes(range(256)) * (size // 256) + b'\x01' * (size % 256)
+            self.assertEqual(call('echo', data), data)
+
+    def test_request_ids_match_replies(self):
+        c = _rpc.Connection(host)
+        try:
+            rids = [c.submit('echo', pack(i)) for i in range(10)]
+            self.assertEqual(len(set(rids)), 10)
+            for i, rid in reversed(list(enumerate(rids))):
+                self.assertEqual(unpack_value(c.result(rid)), i)
+        finally:
+            c.close()
+
+class Pipelining(unittest.TestCase):
+    def test_replies_in_reverse_order(self):
+        released.clear()
+        c = _rpc.Connection(host)
+        try:
+            waiting = c.submit('wait')
+            releasing = c.submit('release')
+            # the reply to wait can only come after the one to release
+            self.assertIs(unpack_value(c.result(waiting)), True)
+            self.assertIs(unpack_value(c.result(releasing)), True)
+        finally:
+            c.close()
+
+    def test_pipeline_keeps_the_order_of_requests(self):
+        released.clear()
+        replies = _rpc.pipeline([('wait', b''), ('release', b''),
+                                 ('echo', pack('c'))], host)
+        self.assertEqual([unpack_value(r) for r in replies],
+                         [True, True, 'c'])
+
+class Errors(unittest.TestCase):
+    def test_handler_error_reaches_the_client(self):
+        with self.assertRaises(_rpc.RemoteError) as e:
+            call('fail', 'broken')
+        self.assertEqual(str(e.exception), 'ValueError: broken')
+        # the connection is still usable
+        self.assertEqual(call('echo', 1), 1)
+
+    def test_unknown_action(self):
+        with self.assertRaises(_rpc.RemoteError):
+            call('nope')
+
+class Streams(unittest.TestCase):
+    def test_pushed_values(self):
+        values = [unpack_value(payload) for payload
+                  in _rpc.stream('count', pack(5), host, timeout=5)]
+        self.assertEqual(values, [0, 1, 2, 3, 4])
+
+    def test_async_stream(self):
+        async def collect():
+            return [unpack_value(payload) async for payload
+                    in _rpc.astream('count', pack(3), host, timeout=5)]
+        self.assertEqual(asyncio.run(collect()), [0, 1, 2])
+
+class Async(unittest.TestCase):
+    def test_round_trip_and_error(self):
+        async def run():
+            value = unpack_value(await _rpc._acomm('echo', pack(b'y' * 2000),
+                                                   host))
+            with self.assertRaises(_rpc.RemoteError):
+                await _rpc._acomm('fail', pack('async'), host)
+            return value
+        self.assertEqual(asyncio.run(run()), b'y' * 2000)
+
+if __name__ == '__main__':
+    unittest.main()
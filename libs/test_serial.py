@@ -0,0 +1,229 @@
+""" The ring buffer, subscribers, buffered reader and ports of the serial
+server.
+
+    python -m pytest libs/test_serial.py
+"""
+import queue
+import random
+import threading
+import time
+import unittest
+
+from srd.libs._serial import BufferedReader, Port, RingBuffer, Subscriber
+
+class RingBufferTest(unittest.TestCase):
+    def test_against_bytearray(self):
+        rng = random.Random(1)
+        for _ in range(200):
+            size = rng.randint(1, 40)
+            ring = RingBuffer(size)
+            expected = bytearray()
+            dropped = overruns = received = 0
+            for _ in range(100):
+                if rng.random() < 0.5:
+                    data = bytes(rng.randrange(256)
+                                 for _ in range(rng.randint(0, 2 * size)))
+                    ring.put(data)
+                    received += len(data)
+                    expected += data
+                    if len(expected) > size:
+                        overruns += 1
+                        dropped += len(expected) - size
+                        del expected[:len(expected) - size]
+                else:
+                    n = rng.randint(0, size + 5)
+                    self.assertEqual(ring.get(n), bytes(expected[:n]))
+                    del expected[:n]
+                self.assertEqual(ring.peek(), bytes(expected))
+                self.assertEqual(len(ring), len(expected))
+                stats = ring.stats()
+                self.assertEqual(stats['dropped'], dropped)
+                self.assertEqual(stats['overruns'], overruns)
+                self.assertEqual(stats['received'], received)
+
+    def test_wrap_around(self):
+        ring = RingBuffer(8)
+        ring.put(b'abcdef')
+        self.assertEqual(ring.get(4), b'abcd')
+        ring.put(b'ghijk')
+        self.assertEqual(ring.peek(), b'efghijk')
+        self.assertEqual(ring.get(100), b'efghijk')
+        self.assertEqual(ring.get(1), b'')
+
+    def test_overrun_keeps_newest(self):
+        ring = RingBuffer(4)
+        ring.put(b'abc')
+        ring.put(b'def')
+        self.assertEqual(ring.peek(), b'cdef')
+        ring.put(b'0123456789')
+        self.assertEqual(ring.peek(), b'6789')
+        self.assertEqual(ring.stats(), {
+            'size': 4, 'occupancy': 4, 'high_water': 4, 'received': 16,
+            'overruns': 2, 'dropped': 12})
+
+class SubscriberTest(unittest.TestCase):
+    def test_lines_across_chunks(self):
+        s = Subscriber(b'\r\n', 1 << 10)
+        s.feed(b'one\r')
+        s.feed(b'\ntwo\r\nthr')
+        self.assertEqual(s.take(0), [b'one\r\n', b'two\r\n'])
+        s.feed(b'ee\r\n')
+        self.assertEqual(s.take(0), [b'three\r\n'])
+
+    def test_raw_chunks(self):
+        s = Subscriber(None, 1 << 10)
+        s.feed(b'a\nb')
+        s.feed(b'c')
+        self.assertEqual(s.take(0), [b'a\nb', b'c'])
+
+    def test_partial_line_over_limit_is_flushed(self):
+        s = Subscriber(b'\n', 8)
+        s.feed(b'0123')
+        self.assertEqual(s.take(0), [])
+        s.feed(b'456789')
+        self.assertEqual(s.take(0), [b'0123456789'])
+        s.feed(b'x\n')
+        self.assertEqual(s.take(0), [b'x\n'])
+
+    def test_oldest_dropped_over_limit(self):
+        s = Subscriber(b'\n', 10)
+        for line in b'aaaa\n', b'bbbb\n', b'cccc\n':
+            s.feed(line)
+        self.assertEqual(s.stats(), {'queued': 2, 'dropped': 1})
+        self.assertEqual(s.take(0), [b'bbbb\n', b'cccc\n'])
+
+    def test_take_waits(self):
+        s = Subscriber(b'\n', 10)
+        t0 = time.monotonic()
+        self.assertEqual(s.take(0.05), [])
+        self.assertGreaterEqual(time.monotonic() - t0, 0.04)
+        threading.Timer(0.02, s.feed, [b'x\n']).start()
+        self.assertEqual(s.take(5), [b'x\n'])
+        s.close()
+        self.assertEqual(s.take(5), [])
+        self.assertTrue(s.closed)
+
+class FakePort(object):
+    """ Port whose reads return what was given to receive(). """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.error = None
+        self._data = queue.Queue()
+
+    @property
+    def in_waiting(self):
+        return self._data.qsize()
+
+    def receive(self, data):
+        for byte in data:
+            self._data.put(bytes([byte]))
+
+    # a loopback, whatever is written is received
+    write = receive
+
+    def read(self, size=1):
+        if self.error is not None:
+            raise self.error
+        out = b''
+        try:
+            out += self._data.get(timeout=self.timeout)
+            while len(out) < size:
+                out += self._data.get_nowait()
+        except queue.Empty:
+            pass
+        return out
+
+class BufferedReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.port = FakePort(timeout=0.5)
+        self.reader = BufferedReader(self.port, 64)
+
+    def tearDown(self):
+        self.reader.close()
+
+    def test_keeps_the_client_timeout(self):
+        self.assertEqual(self.reader.timeout, 0.5)
+        self.assertEqual(self.port.timeout, BufferedReader.POLL)
+
+    def test_read_returns_buffered_data_at_once(self):
+        self.port.receive(b'abcdef')
+        time.sleep(0.1)
+        t0 = time.monotonic()
+        self.assertEqual(self.reader.read(4), b'abcd')
+        self.assertLess(time.monotonic() - t0, 0.05)
+        self.assertEqual(self.reader.stats()['occupancy'], 2)
+
+    def test_read_times_out_with_what_there_is(self):
+        self.reader.timeout = 0.1
+        self.port.receive(b'ab')
+        t0 = time.monotonic()
+        self.assertEqual(self.reader.read(5), b'ab')
+        self.assertGreaterEqual(time.monotonic() - t0, 0.09)
+        self.reader.timeout = 0
+        self.assertEqual(self.reader.read(5), b'')
+
+    def test_read_until(self):
+        threading.Timer(0.05, self.port.receive, [b'12\r']).start()
+        threading.Timer(0.1, self.port.receive, [b'\n34\r\n']).start()
+        self.assertEqual(self.reader.read_until(b'\r\n'), b'12\r\n')
+        self.assertEqual(self.reader.read_until(b'\r\n'), b'34\r\n')
+
+    def test_read_until_size(self):
+        self.port.receive(b'0123456789\n')
+        self.assertEqual(self.reader.read_until(b'\n', 4), b'0123')
+        self.assertEqual(self.reader.read_until(b'\n', 40), b'456789\n')
+
+    def test_read_until_timeout(self):
+        self.reader.timeout = 0.1
+        self.port.receive(b'no end')
+        self.assertEqual(self.reader.read_until(b'\n'), b'no end')
+
+    def test_subscribers_see_the_data(self):
+        sid = self.reader.subscribe(b'\n', 1 << 10)
+        self.port.receive(b'a\nb\n')
+        subscriber = self.reader.subscribers[sid]
+        lines = []
+        while len(lines) < 2:
+            lines += subscriber.take(1)
+        self.assertEqual(lines, [b'a\n', b'b\n'])
+        self.reader.timeout = 0.1
+        self.assertEqual(self.reader.read(4), b'')
+
+    def test_port_error_is_raised_once_buffer_is_empty(self):
+        self.port.receive(b'ok')
+        time.sleep(0.1)
+        self.port.error = OSError('device disconnected')
+        sid = self.reader.subscribe(b'\n', 1 << 10)
+        self.assertEqual(self.reader.read(2), b'ok')
+        with self.assertRaises(OSError):
+            self.reader.read(1)
+        self.assertTrue(self.reader.subscribers[sid].closed)
+
+class PortTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakePort(timeout=0.5)
+        # a Port around the fake instead of a serial.Serial
+        self.port = Port.__new__(Port)
+        self.port.ser = self.fake
+        self.port.reader = BufferedReader(self.fake, 64)
+
+    def tearDown(self):
+        self.port.reader.close()
+
+    def test_query_drops_earlier_input(self):
+        self.fake.receive(b'stale\n')
+        time.sleep(0.1)
+        self.assertEqual(self.port.query(b'x\n'), b'x\n')
+
+    def test_query_after_subscribe(self):
+        sid = self.port.subscribe(b'\n', 1 << 10)
+        self.fake.receive(b'a\nb\n')
+        subscriber = self.port.reader.subscribers[sid]
+        lines = []
+        while len(lines) < 2:
+            lines += subscriber.take(1)
+        self.assertEqual(self.port.query(b'x\n'), b'x\n')
+        self.assertEqual(subscriber.take(1), [b'x\n'])
+
+if __name__ == '__main__':
+    unittest.main()